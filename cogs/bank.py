@@ -1,17 +1,23 @@
-from collections import namedtuple, defaultdict
-from copy import deepcopy
+from collections import defaultdict
 from datetime import datetime
+from itertools import islice
+import asyncio
+import os
+import weakref
 
 import discord
 from discord.ext import commands
 from pip import logger
 
-from cogs.utils.chat_formatting import pagify, box
+from cogs.utils.bank_storage import AccountRecord, get_storage
+from cogs.utils.chat_formatting import pagify_lines, box
 from cogs.utils.dataIO import dataIO
 from cogs.utils.set_parser import SetParser
 from .utils import checks
 
 default_settings = {"REGISTER_CREDITS": 100}
+default_backend = "journal"
+default_format = "compact"
 
 
 class BankError(Exception):
@@ -38,32 +44,128 @@ class SameSenderAndReceiver(BankError):
     pass
 
 
+_MISSING = object()
+
+
+class Account:
+    """A user's bank account on a server
+
+    created_at and member are only resolved when first accessed, so
+    building many accounts (e.g. leaderboards) stays cheap"""
+    __slots__ = ("id", "name", "balance", "server",
+                 "_created_at", "_member")
+    _fields = ("id", "name", "balance", "created_at", "server", "member")
+
+    def __init__(self, user_id, server, record, member=_MISSING):
+        self.id = user_id
+        self.name = record.name
+        self.balance = record.balance
+        self.server = server
+        self._created_at = record.created_at
+        self._member = member
+
+    @property
+    def created_at(self):
+        if isinstance(self._created_at, str):
+            self._created_at = datetime.strptime(self._created_at,
+                                                 "%Y-%m-%d %H:%M:%S")
+        return self._created_at
+
+    @property
+    def member(self):
+        if self._member is _MISSING:
+            self._member = self.server.get_member(self.id)
+        return self._member
+
+    def __iter__(self):  # Unpacks like the namedtuple it replaces
+        return (getattr(self, f) for f in self._fields)
+
+    def __repr__(self):
+        return "<Account id={0.id} name={0.name!r} balance={0.balance} " \
+               "server={0.server}>".format(self)
+
+
+class AccountLocks:
+    """Hands out an asyncio.Lock per (server, user) account
+
+    A lock only exists while someone holds it or waits for it. Locking
+    several accounts acquires them in sorted order, so two concurrent
+    transfers between the same users can't deadlock
+
+        async with bank.locks(sender, receiver):
+            ..."""
+
+    def __init__(self):
+        self._locks = weakref.WeakValueDictionary()
+
+    def get(self, server_id, user_id):
+        key = (server_id, user_id)
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[key] = lock
+        return lock
+
+    def __call__(self, *users):
+        keys = sorted({(user.server.id, user.id) for user in users})
+        return _HeldLocks([self.get(*key) for key in keys])
+
+
+class _HeldLocks:
+    # Keeps the locks alive until they're released
+
+    def __init__(self, locks):
+        self.locks = locks
+
+    async def __aenter__(self):
+        acquired = []
+        try:
+            for lock in self.locks:
+                await lock.acquire()
+                acquired.append(lock)
+        except:
+            for lock in reversed(acquired):
+                lock.release()
+            raise
+
+    async def __aexit__(self, *exc_info):
+        for lock in reversed(self.locks):
+            lock.release()
+
+
 class Bank:
 
     def __init__(self, bot):
         self.file_path = "data/bank/bank.json"
         self.settings_path = "data/bank/settings.json"
-        self.accounts = dataIO.load_json(self.file_path)
         self.bot = bot
-        self.settings = dataIO.load_json(self.settings_path)
+        self.storage = bot.get_service("bank_storage", self._open_storage)
+        # Shared with every Bank instance, such as the one in Slots
+        self.locks = bot.get_service("bank_locks", AccountLocks)
         self.settings = defaultdict(lambda: default_settings)
 
+    def __unload(self):
+        # The storage is shared with other cogs and closed on logout
+        self.storage.flush()
+
+    def _open_storage(self):
+        settings = dataIO.load_json(self.settings_path)
+        backend = settings.get("BACKEND", default_backend)
+        dataIO.set_format(self.file_path,
+                          settings.get("FORMAT", default_format))
+        return get_storage(backend, self.file_path)
+
     def create_account(self, user, *, initial_balance=0):
         server = user.server
         if not self.account_exists(user):
-            if server.id not in self.accounts:
-                self.accounts[server.id] = {}
-            if user.id in self.accounts:  # Legacy account
-                balance = self.accounts[user.id]["balance"]
+            legacy = self.storage.get_legacy_account(user.id)
+            if legacy is not None:  # Legacy account
+                balance = legacy["balance"]
             else:
                 balance = initial_balance
             timestamp = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-            account = {"name": user.name,
-                       "balance": balance,
-                       "created_at": timestamp
-                       }
-            self.accounts[server.id][user.id] = account
-            self._save_bank()
+            account = AccountRecord(user.name, balance, timestamp)
+            self.storage.set_account(server.id, user.id, account)
             return self.get_account(user)
         else:
             raise AccountAlreadyExists()
@@ -82,10 +184,9 @@ class Bank:
             raise NegativeValue()
 
         account = self._get_account(user)
-        if account["balance"] >= amount:
-            account["balance"] -= amount
-            self.accounts[server.id][user.id] = account
-            self._save_bank()
+        if account.balance >= amount:
+            account = account._replace(balance=account.balance - amount)
+            self.storage.set_account(server.id, user.id, account)
         else:
             raise InsufficientBalance()
 
@@ -94,18 +195,16 @@ class Bank:
         if amount < 0:
             raise NegativeValue()
         account = self._get_account(user)
-        account["balance"] += amount
-        self.accounts[server.id][user.id] = account
-        self._save_bank()
+        account = account._replace(balance=account.balance + amount)
+        self.storage.set_account(server.id, user.id, account)
 
     def set_credits(self, user, amount):
         server = user.server
         if amount < 0:
             raise NegativeValue()
         account = self._get_account(user)
-        account["balance"] = amount
-        self.accounts[server.id][user.id] = account
-        self._save_bank()
+        account = account._replace(balance=amount)
+        self.storage.set_account(server.id, user.id, account)
 
     def transfer_credits(self, sender, receiver, amount):
         if amount < 0:
@@ -114,79 +213,110 @@ class Bank:
             raise SameSenderAndReceiver()
         if self.account_exists(sender) and self.account_exists(receiver):
             sender_acc = self._get_account(sender)
-            if sender_acc["balance"] < amount:
+            if sender_acc.balance < amount:
                 raise InsufficientBalance()
             self.withdraw_credits(sender, amount)
             self.deposit_credits(receiver, amount)
         else:
             raise NoAccount()
 
+    def settle_bet(self, user, bid, payout):
+        """Takes the bid and pays the payout in a single update
+
+        Returns the balance before and after the bet"""
+        server = user.server
+        if bid < 0 or payout < 0:
+            raise NegativeValue()
+        account = self._get_account(user)
+        if account.balance < bid:
+            raise InsufficientBalance()
+        then = account.balance
+        now = then - bid + payout
+        if now != then:
+            account = account._replace(balance=now)
+            self.storage.set_account(server.id, user.id, account)
+        return then, now
+
     def can_spend(self, user, amount):
         account = self._get_account(user)
-        if account["balance"] >= amount:
+        if account.balance >= amount:
             return True
         else:
             return False
 
     def wipe_bank(self, server):
-        self.accounts[server.id] = {}
-        self._save_bank()
+        self.storage.wipe_server(server.id)
 
     def get_server_accounts(self, server):
-        if server.id in self.accounts:
-            raw_server_accounts = deepcopy(self.accounts[server.id])
-            accounts = []
-            for k, v in raw_server_accounts.items():
-                v["id"] = k
-                v["server"] = server
-                acc = self._create_account_obj(v)
-                accounts.append(acc)
-            return accounts
-        else:
-            return []
+        raw_server_accounts = self.storage.get_server_accounts(server.id)
+        accounts = []
+        for k, v in raw_server_accounts.items():
+            acc = self._create_account_obj(k, server, v)
+            accounts.append(acc)
+        return accounts
 
     def get_all_accounts(self):
         accounts = []
-        for server_id, v in self.accounts.items():
+        for server_id in self.storage.get_server_ids():
             server = self.bot.get_server(server_id)
             if server is None:
                 # Servers that have since been left will be ignored
                 # Same for users_id from the old bank format
                 continue
-            raw_server_accounts = deepcopy(self.accounts[server.id])
+            raw_server_accounts = self.storage.get_server_accounts(server.id)
             for k, v in raw_server_accounts.items():
-                v["id"] = k
-                v["server"] = server
-                acc = self._create_account_obj(v)
+                acc = self._create_account_obj(k, server, v)
                 accounts.append(acc)
         return accounts
 
+    def get_server_leaderboard(self, server, top):
+        """Returns the server's richest accounts, highest balance first
+
+        Users that have left the server are excluded"""
+        return list(islice(self.iter_server_leaderboard(server), top))
+
+    def iter_server_leaderboard(self, server):
+        for user_id, raw in self.storage.iter_server_ranking(server.id):
+            member = server.get_member(user_id)
+            if member is None:
+                continue
+            yield Account(user_id, server, raw, member)
+
+    def get_global_leaderboard(self, top):
+        """Returns the richest users across all servers, each one listed
+        with their richest account"""
+        return list(islice(self.iter_global_leaderboard(), top))
+
+    def iter_global_leaderboard(self):
+        seen = set()
+        for server_id, user_id, raw in self.storage.iter_global_ranking():
+            if user_id in seen:
+                continue
+            server = self.bot.get_server(server_id)
+            if server is None:
+                continue
+            member = server.get_member(user_id)
+            if member is None:
+                continue
+            seen.add(user_id)
+            yield Account(user_id, server, raw, member)
+
     def get_balance(self, user):
         account = self._get_account(user)
-        return account["balance"]
+        return account.balance
 
     def get_account(self, user):
         acc = self._get_account(user)
-        acc["id"] = user.id
-        acc["server"] = user.server
-        return self._create_account_obj(acc)
+        return self._create_account_obj(user.id, user.server, acc)
 
     @staticmethod
-    def _create_account_obj(account):
-        account["member"] = account["server"].get_member(account["id"])
-        account["created_at"] = datetime.strptime(account["created_at"],
-                                                  "%Y-%m-%d %H:%M:%S")
-        Account = namedtuple("Account", "id name balance "
-                                        "created_at server member")
-        return Account(**account)
-
-    def _save_bank(self):
-        dataIO.save_json("data/slots/bank.json", self.accounts)
+    def _create_account_obj(user_id, server, record):
+        return Account(user_id, server, record)
 
     def _get_account(self, user):
         server = user.server
         try:
-            return deepcopy(self.accounts[server.id][user.id])
+            return self.storage.get_account(server.id, user.id)
         except KeyError:
             raise NoAccount()
 
@@ -238,7 +368,8 @@ class Bank:
         """Transfer credits to other users"""
         author = ctx.message.author
         try:
-            self.transfer_credits(author, user, sum)
+            async with self.locks(author, user):
+                self.transfer_credits(author, user, sum)
             logger.info("{}({}) transferred {} credits to {}({})".format(
                 author.name, author.id, sum, user.name, user.id))
             await self.bot.say("{} credits have been transferred to {}'s"
@@ -262,30 +393,31 @@ class Bank:
             bank set @GetLucky +2 - Adds 2 credits
             bank set @GetLucky -6 - Removes 6 credits"""
         author = ctx.message.author
-        try:
-            if credits.operation == "deposit":
-                self.deposit_credits(user, credits.sum)
-                logger.info("{}({}) added {} credits to {} ({})".format(
-                    author.name, author.id, credits.sum, user.name, user.id))
-                await self.bot.say("{} credits have been added to {}"
-                                   "".format(credits.sum, user.name))
-            elif credits.operation == "withdraw":
-                self.withdraw_credits(user, credits.sum)
-                logger.info("{}({}) removed {} credits to {} ({})".format(
-                    author.name, author.id, credits.sum, user.name, user.id))
-                await self.bot.say("{} credits have been withdrawn from {}"
-                                   "".format(credits.sum, user.name))
-            elif credits.operation == "set":
-                self.set_credits(user, credits.sum)
-                logger.info("{}({}) set {} credits to {} ({})"
-                            "".format(author.name, author.id, credits.sum,
-                                      user.name, user.id))
-                await self.bot.say("{}'s credits have been set to {}".format(
-                    user.name, credits.sum))
-        except InsufficientBalance:
-            await self.bot.say("User doesn't have enough credits.")
-        except NoAccount:
-            await self.bot.say("User has no bank account.")
+        async with self.locks(user):
+            try:
+                if credits.operation == "deposit":
+                    self.deposit_credits(user, credits.sum)
+                    logger.info("{}({}) added {} credits to {} ({})".format(
+                        author.name, author.id, credits.sum, user.name, user.id))
+                    await self.bot.say("{} credits have been added to {}"
+                                       "".format(credits.sum, user.name))
+                elif credits.operation == "withdraw":
+                    self.withdraw_credits(user, credits.sum)
+                    logger.info("{}({}) removed {} credits to {} ({})".format(
+                        author.name, author.id, credits.sum, user.name, user.id))
+                    await self.bot.say("{} credits have been withdrawn from {}"
+                                       "".format(credits.sum, user.name))
+                elif credits.operation == "set":
+                    self.set_credits(user, credits.sum)
+                    logger.info("{}({}) set {} credits to {} ({})"
+                                "".format(author.name, author.id, credits.sum,
+                                          user.name, user.id))
+                    await self.bot.say("{}'s credits have been set to {}".format(
+                        user.name, credits.sum))
+            except InsufficientBalance:
+                await self.bot.say("User doesn't have enough credits.")
+            except NoAccount:
+                await self.bot.say("User has no bank account.")
 
     @_bank.command(pass_context=True, no_pm=True)
     @checks.serverowner_or_permissions(administrator=True)
@@ -317,24 +449,16 @@ class Bank:
         server = ctx.message.server
         if top < 1:
             top = 10
-        bank_sorted = sorted(self.get_server_accounts(server),
-                             key=lambda x: x.balance, reverse=True)
-        bank_sorted = [a for a in bank_sorted if a.member]  # exclude users who left
-        if len(bank_sorted) < top:
-            top = len(bank_sorted)
-        topten = bank_sorted[:top]
-        highscore = ""
-        place = 1
-        for acc in topten:
-            highscore += str(place).ljust(len(str(top)) + 1)
-            highscore += (str(acc.member.display_name) + " ").ljust(23 - len(str(acc.balance)))
-            highscore += str(acc.balance) + "\n"
-            place += 1
-        if highscore != "":
-            for page in pagify(highscore, shorten_by=12):
-                await self.bot.say(box(page, lang="py"))
-        else:
-            await self.bot.say("There are no accounts in the bank.")
+        # Collected before the first page is sent: the rankings can
+        # change while awaiting
+        topten = self.get_server_leaderboard(server, top)
+        place_width = len(str(top)) + 1
+        highscore = (str(place).ljust(place_width) +
+                     (str(acc.member.display_name) + " ").ljust(
+                         23 - len(str(acc.balance))) +
+                     str(acc.balance)
+                     for place, acc in enumerate(topten, 1))
+        await self._send_leaderboard(highscore)
 
     @leaderboard.command(name="global")
     async def _global_leaderboard(self, top: int = 10):
@@ -343,28 +467,25 @@ class Bank:
         Defaults to top 10"""
         if top < 1:
             top = 10
-        bank_sorted = sorted(self.get_all_accounts(),
-                             key=lambda x: x.balance, reverse=True)
-        bank_sorted = [a for a in bank_sorted if a.member]  # exclude users who left
-        unique_accounts = []
-        for acc in bank_sorted:
-            if not self.already_in_list(unique_accounts, acc):
-                unique_accounts.append(acc)
-        if len(unique_accounts) < top:
-            top = len(unique_accounts)
-        topten = unique_accounts[:top]
-        highscore = ""
-        place = 1
-        for acc in topten:
-            highscore += str(place).ljust(len(str(top)) + 1)
-            highscore += ("{} |{}| ".format(acc.member, acc.server)
-            ).ljust(23 - len(str(acc.balance)))
-            highscore += str(acc.balance) + "\n"
-            place += 1
-        if highscore != "":
-            for page in pagify(highscore, shorten_by=12):
-                await self.bot.say(box(page, lang="py"))
-        else:
+        topten = self.get_global_leaderboard(top)
+        place_width = len(str(top)) + 1
+        highscore = (str(place).ljust(place_width) +
+                     ("{} |{}| ".format(acc.member, acc.server)).ljust(
+                         23 - len(str(acc.balance))) +
+                     str(acc.balance)
+                     for place, acc in enumerate(topten, 1))
+        await self._send_leaderboard(highscore)
+
+    async def _send_leaderboard(self, lines):
+        """Sends the leaderboard's pages as soon as each one is full
+
+        lines must not depend on the live rankings, which other commands
+        can change between two pages"""
+        empty = True
+        for page in pagify_lines(lines, shorten_by=12):
+            empty = False
+            await self.bot.say(box(page, lang="py"))
+        if empty:
             await self.bot.say("There are no accounts in the bank.")
 
     def already_in_list(self, accounts, user):
@@ -374,19 +495,29 @@ class Bank:
         return False
 
 
+def check_folders():
+    if not os.path.exists("data/bank"):
+        print("Creating data/bank folder...")
+        os.makedirs("data/bank")
+
+
 def check_files():
     f = "data/bank/bank.json"
-    if not dataIO.is_valid_json(f):
+    # Only created if missing: a bank file that can't be read, e.g. saved
+    # as msgpack while msgpack is no longer installed, still holds every
+    # account and must never be replaced
+    if not os.path.exists(f):
         print("Creating empty bank.json...")
         dataIO.save_json(f, {})
 
     f = "data/bank/settings.json"
-    if not dataIO.is_valid_json(f):
+    if not dataIO.exists_and_valid(f):
         print("Creating empty settings.json...")
         dataIO.save_json(f, {})
 
 
 def setup(bot):
+    check_folders()
     check_files()
     n = Bank(bot)
     bot.add_cog(n)
@@ -918,6 +918,18 @@ class Owner:
         else:
             await self.bot.say("No exception has occurred yet.")
 
+    @commands.command()
+    @checks.is_owner()
+    async def messagestats(self):
+        """Shows how many messages each stage of the pipeline dropped"""
+        counter = self.bot.counter
+        msg = "Messages read: {}\n".format(counter["messages_read"])
+        for stage in self.bot.MESSAGE_STAGES:
+            msg += "Dropped by {}: {}\n".format(
+                stage, counter["messages_dropped_" + stage])
+        msg += "Commands processed: {}".format(counter["processed_commands"])
+        await self.bot.say(box(msg))
+
     def _populate_list(self, _list):
         """Used for both whitelist / blacklist
 
@@ -1052,10 +1064,11 @@ class Owner:
         return fmt.format(d=days, h=hours, m=minutes, s=seconds)
 
     def save_global_ignores(self):
-        dataIO.save_json("data/red/global_ignores.json", self.global_ignores)
+        dataIO.mark_dirty("data/red/global_ignores.json", self.global_ignores)
+        self.bot.invalidate_permissions()
 
     def save_disabled_commands(self):
-        dataIO.save_json("data/red/disabled_commands.json", self.disabled_commands)
+        dataIO.mark_dirty("data/red/disabled_commands.json", self.disabled_commands)
 
 
 def _import_old_data(data):
@@ -1,17 +1,25 @@
 from cogs.bank import Bank, InsufficientBalance, NoAccount
 from discord.ext import commands
 from cogs.utils.dataIO import dataIO
-from collections import defaultdict, deque
-from datetime import datetime
+from cogs.utils.slot_machine import (SMReel, SM_REEL_MULTIPLIERS, Payout,
+                                     PayoutTable, RandomSeeds, spin)
+from collections import defaultdict
 from .utils import checks
-from enum import Enum
-from random import shuffle
+from math import ceil
 import os
 import logging
-import random
+import time
+
+# SMReel and Payout moved to cogs/utils/slot_machine.py and are
+# re-exported so they can still be imported from here
+__all__ = ["Slots", "SlotError", "InvalidBid", "SlotCooldown", "SMReel",
+           "SM_REEL_MULTIPLIERS", "Payout", "setup"]
 
 default_settings = {"SLOT_MIN": 1, "SLOT_MAX": 999999999999999999, "SLOT_TIME": 0}
 
+# Seconds between two sweeps of the users whose cooldown is over
+EVICTION_INTERVAL = 300
+
 
 class SlotError(Exception):
     pass
@@ -21,92 +29,10 @@ class InvalidBid(SlotError):
     pass
 
 
-NUM_ENC = "\N{COMBINING ENCLOSING KEYCAP}"
-
-
-class SMReel(Enum):
-    wild = "\N{GAME DIE}"
-    cherries = "\N{CHERRIES}"
-    medal = "\N{SPORTS MEDAL}"
-    flc = "\N{FOUR LEAF CLOVER}"
-    dollar = "\N{BANKNOTE WITH DOLLAR SIGN}"
-    bell = "\N{BELL}"
-    moneystack = "\N{MONEY WITH WINGS}"
-    heart = "\N{HEAVY BLACK HEART}"
-    spade = "\N{BLACK SPADE SUIT}"
-    gem = "\N{GEM STONE}"
-    moneybag = "\N{MONEY BAG}"
-    seven = "\N{DIGIT SEVEN}" + NUM_ENC
-
-
-SM_REEL_MULTIPLIERS = {
-    SMReel.cherries: [0, 0, 2, 5, 10, 100],
-    SMReel.medal: [0, 0, 0, 5, 10, 100],
-    SMReel.flc: [0, 0, 0, 5, 20, 100],
-    SMReel.dollar: [0, 0, 0, 5, 20, 100],
-    SMReel.bell: [0, 0, 0, 10, 50, 100],
-    SMReel.moneystack: [0, 0, 0, 10, 50, 100],
-    SMReel.heart: [0, 0, 0, 20, 80, 120],
-    SMReel.spade: [0, 0, 0, 20, 80, 120],
-    SMReel.gem: [0, 0, 0, 50, 100, 150],
-    SMReel.moneybag: [0, 0, 0, 50, 100, 150],
-    SMReel.seven: [0, 0, 10, 50, 100, 300]}
-
-
-class Payout:
-    @staticmethod
-    def getsymbolcount(in_line, i):
-        count = list([1, SMReel.wild])
-        line = list(in_line)
-
-        if line[i] == SMReel.wild:
-            for j in range(i, len(line) - 1):
-                if line[j] != SMReel.wild:
-                    line[i] = line[j]
-
-        count[1] = line[i]
-
-        for j in range(i, len(line) - 1):
-            if (line[j] == line[j + 1]) or (line[j + 1] == SMReel.wild):
-                line[j + 1] = line[j]
-                count[0] += 1
-            else:
-                return count
-        return count
-
-    @staticmethod
-    def getmultiplierpayout(symbol, count, bet):
-        return [SM_REEL_MULTIPLIERS[symbol][count] * bet, symbol, count]
-
-    @staticmethod
-    def getskipcount(i, count, line):
-        linePos = i + count - 1
-        skip = 0
-
-        while line[linePos] == SMReel.wild:
-            skip += 1
-            linePos -= 1
-
-        return i + (count - skip)
-
-    @staticmethod
-    def getlinepayout(line, bet):
-        payout = []
-        skip = -1
-        for i, symbol in enumerate(line):
-            if skip > i or i == 4:
-                continue
-            count = Payout.getsymbolcount(line, i)
-
-            if count[0] == 2 and (count[1] == SMReel.seven or count[1] == SMReel.cherries):
-                payout.append(Payout.getmultiplierpayout(count[1], 2, bet))
-            elif count[0] > 2:
-                payout.append(Payout.getmultiplierpayout(count[1], count[0], bet))
-            if line[i + count[0] - 1] == SMReel.wild:
-                skip = Payout.getskipcount(i, count[0], line)
-            else:
-                skip = i + count[0]
-        return payout
+class SlotCooldown(SlotError):
+    def __init__(self, wait):
+        super().__init__(wait)
+        self.wait = wait
 
 
 class Slots:
@@ -114,13 +40,18 @@ class Slots:
 
     Get rich and have fun with imaginary currency!"""
 
-    def __init__(self, bot):
+    def __init__(self, bot, seeds=None):
         self.bot = bot
         self.bank = Bank(bot)
         self.file_path = "data/slots/settings.json"
         self.settings = dataIO.load_json(self.file_path)
-        self.settings = defaultdict(lambda: default_settings)
+        # server id -> user id -> time.monotonic() when the user can play
         self.slot_register = defaultdict(dict)
+        self.last_eviction = time.monotonic()
+        self.payouts = PayoutTable()
+        # Anything with a next_seed() returning 64 bit ints, such as
+        # SystemSeeds or NumpySeeds from cogs.utils.slot_machine
+        self.seeds = seeds or RandomSeeds()
 
     @commands.group(name="slots", pass_context=True, no_pm=True)
     async def _slots(self, ctx):
@@ -140,15 +71,21 @@ class Slots:
         """Play the slot machine"""
         author = ctx.message.author
         server = author.server
-        settings = self.settings[server.id]
+        settings = self.get_settings(server)
         valid_bid = settings["SLOT_MIN"] <= bid <= settings["SLOT_MAX"]
 
         try:
             if not valid_bid:
                 raise InvalidBid()
-            if not self.bank.can_spend(author, bid):
-                raise InsufficientBalance
+            # Checked before any bank access, but the token is only
+            # taken once the bid has been settled
+            wait = self.get_slot_wait(server, author)
+            if wait:
+                raise SlotCooldown(wait)
             await self.slot_machine(author, bid, multislotbool)
+        except SlotCooldown as e:
+            await self.bot.say("{} You can play again in {} seconds."
+                               "".format(author.mention, ceil(e.wait)))
         except NoAccount:
             await self.bot.say("{} You need an account to use the slot "
                                "machine. Type `{}bank register` to open one."
@@ -162,21 +99,73 @@ class Slots:
                                          settings["SLOT_MAX"]))
 
     async def slot_machine(self, author, bid, multislot):
-        reels = []
-        self.slot_register[author.id] = datetime.utcnow()
-        for i in range(5):
-            default_reel = deque(SMReel)
-            if i < 1 or i > 3:
-                default_reel.remove(SMReel.wild)
-
-            shuffle(default_reel)
-            default_reel.rotate(random.randint(-999, 999))  # weeeeee
-            new_reel = deque(default_reel, maxlen=5)  # we need only 5 symbols
-            reels.append(new_reel)  # for each reel
-        rows = ((reels[0][0], reels[1][0], reels[2][0], reels[3][0], reels[4][0]),
-                (reels[0][1], reels[1][1], reels[2][1], reels[3][1], reels[4][1]),
-                (reels[0][2], reels[1][2], reels[2][2], reels[3][2], reels[4][2]))
+        seed = self.seeds.next_seed()
+        rows = spin(seed)
+        slot = Slots.render(rows, multislot)
+
+        if multislot:
+            payout = self.payouts.getlinepayout(rows[0], int(bid / 3))
+            payout.extend(self.payouts.getlinepayout(rows[1], int(bid / 3)))
+            payout.extend(self.payouts.getlinepayout(rows[2], int(bid / 3)))
+        else:
+            payout = self.payouts.getlinepayout(rows[1], bid)
+
+        pay = 0
+        for win in payout:
+            pay += win[0]
+        async with self.bank.locks(author):
+            # Checked again: another spin may have taken the token
+            wait = self.get_slot_wait(author.server, author)
+            if wait:
+                raise SlotCooldown(wait)
+            then, now = self.bank.settle_bet(author, bid, pay)
+            self.take_slot_token(author.server, author)
+        logger.info("{}({}) spin {:016x} bid {}{} won {}".format(
+            author.name, author.id, seed, bid,
+            " (multislot)" if multislot else "", pay))
 
+        if payout:
+            await self.bot.say("{}\n{} \n{}\nYour total win: {}\nYour bid: {}\n{} → {}!"
+                               "".format(slot, Slots.getpayoutsymbols(payout), author.mention, pay, bid, then, now))
+        else:
+            await self.bot.say("{}\n{} Nothing!\nYour bid: {}\n{} → {}!"
+                               "".format(slot, author.mention, bid, then, now))
+
+    def get_settings(self, server):
+        settings = self.settings.setdefault(server.id, {})
+        for k, v in default_settings.items():
+            settings.setdefault(k, v)
+        return settings
+
+    def get_slot_wait(self, server, user):
+        """Returns the seconds left before the user can play again
+
+        The cooldown is a token bucket of one token, refilled every
+        SLOT_TIME seconds and stored as the time it will be full again"""
+        ready = self.slot_register.get(server.id, {}).get(user.id, 0)
+        return max(ready - time.monotonic(), 0)
+
+    def take_slot_token(self, server, user):
+        cooldown = self.get_settings(server)["SLOT_TIME"]
+        if cooldown <= 0:
+            return
+        now = time.monotonic()
+        self.slot_register[server.id][user.id] = now + cooldown
+        if now - self.last_eviction > EVICTION_INTERVAL:
+            self.evict_idle_users(now)
+
+    def evict_idle_users(self, now):
+        """Forgets the users whose bucket is full again"""
+        for server_id in list(self.slot_register):
+            register = self.slot_register[server_id]
+            for user_id in [u for u, t in register.items() if t <= now]:
+                del register[user_id]
+            if not register:
+                del self.slot_register[server_id]
+        self.last_eviction = now
+
+    @staticmethod
+    def render(rows, multislot):
         slot = "WALCUM TO THE SLOTS\n"
         for i, row in enumerate(rows):  # Let's build the slot to show
             sign = "||"
@@ -189,29 +178,7 @@ class Slots:
                 signi = "<"
 
             slot += "{}{} {} {} {} {}{}\n".format(sign, *[c.value for c in row], signi)
-
-        if multislot:
-            payout = list(Payout.getlinepayout(rows[0], int(bid / 3)))
-            payout.extend(Payout.getlinepayout(rows[1], int(bid / 3)))
-            payout.extend(Payout.getlinepayout(rows[2], int(bid / 3)))
-        else:
-            payout = Payout.getlinepayout(rows[1], bid)
-
-        if payout:
-            then = self.bank.get_balance(author)
-            pay = 0
-            for win in payout:
-                pay += win[0]
-            now = then - bid + pay
-            self.bank.set_credits(author, now)
-            await self.bot.say("{}\n{} \n{}\nYour total win: {}\nYour bid: {}\n{} → {}!"
-                               "".format(slot, Slots.getpayoutsymbols(payout), author.mention, pay, bid, then, now))
-        else:
-            then = self.bank.get_balance(author)
-            self.bank.withdraw_credits(author, bid)
-            now = then - bid
-            await self.bot.say("{}\n{} Nothing!\nYour bid: {}\n{} → {}!"
-                               "".format(slot, author.mention, bid, then, now))
+        return slot
 
     @staticmethod
     def getpayoutsymbols(payout):
@@ -227,7 +194,7 @@ class Slots:
     async def slotsset(self, ctx):
         """Changes slots module settings"""
         server = ctx.message.server
-        settings = self.settings[server.id]
+        settings = self.get_settings(server)
         if ctx.invoked_subcommand is None:
             msg = "```"
             for k, v in settings.items():
@@ -240,25 +207,47 @@ class Slots:
     async def slotmin(self, ctx, bid: int):
         """Minimum slot machine bid"""
         server = ctx.message.server
-        self.settings[server.id]["SLOT_MIN"] = bid
+        self.get_settings(server)["SLOT_MIN"] = bid
         await self.bot.say("Minimum bid is now {} credits.".format(bid))
-        dataIO.save_json(self.file_path, self.settings)
+        dataIO.mark_dirty(self.file_path, self.settings)
 
     @slotsset.command(pass_context=True)
     async def slotmax(self, ctx, bid: int):
         """Maximum slot machine bid"""
         server = ctx.message.server
-        self.settings[server.id]["SLOT_MAX"] = bid
+        self.get_settings(server)["SLOT_MAX"] = bid
         await self.bot.say("Maximum bid is now {} credits.".format(bid))
-        dataIO.save_json(self.file_path, self.settings)
+        dataIO.mark_dirty(self.file_path, self.settings)
 
     @slotsset.command(pass_context=True)
     async def slottime(self, ctx, seconds: int):
         """Seconds between each slots use"""
         server = ctx.message.server
-        self.settings[server.id]["SLOT_TIME"] = seconds
+        self.get_settings(server)["SLOT_TIME"] = seconds
         await self.bot.say("Cooldown is now {} seconds.".format(seconds))
-        dataIO.save_json(self.file_path, self.settings)
+        dataIO.mark_dirty(self.file_path, self.settings)
+
+    @slotsset.command()
+    async def replay(self, seed: str, multislot: bool=False):
+        """Shows the outcome of a logged spin
+
+        The seeds of the spins are in data/slots/slots.log"""
+        try:
+            seed = int(seed, 16)
+        except ValueError:
+            await self.bot.say("That's not a valid seed.")
+            return
+        rows = spin(seed)
+        lines = rows if multislot else rows[1:2]
+        payout = []
+        for row in lines:
+            payout.extend(self.payouts.getlinepayout(row, 1))
+        msg = Slots.render(rows, multislot)
+        if payout:
+            msg += Slots.getpayoutsymbols(payout)
+        else:
+            msg += "Nothing!"
+        await self.bot.say(msg)
 
 
 def check_folders():
@@ -269,7 +258,7 @@ def check_folders():
 
 def check_files():
     f = "data/slots/settings.json"
-    if not dataIO.is_valid_json(f):
+    if not dataIO.exists_and_valid(f):
         print("Creating default slots's settings.json...")
         dataIO.save_json(f, {})
 
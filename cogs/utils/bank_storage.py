@@ -0,0 +1,456 @@
+import heapq
+import json
+import os
+import sqlite3
+import time
+import logging
+from bisect import bisect_left, insort
+from collections import namedtuple
+
+from .dataIO import dataIO, InvalidFileIO, UnsupportedFormat
+
+
+class InvalidBackend(Exception):
+    pass
+
+
+class AccountRecord(namedtuple("AccountRecord", "name balance created_at")):
+    """An account as stored by the backends
+
+    Records are immutable, so they can be handed out without copying.
+    They're saved as [name, balance, created_at] arrays"""
+    __slots__ = ()
+
+    @classmethod
+    def from_raw(cls, raw):
+        """Builds a record from its saved form, either array or dict"""
+        if isinstance(raw, dict):
+            return cls(raw.get("name"), raw["balance"], raw.get("created_at"))
+        return cls(*raw)
+
+
+class BankStorage:
+    """Base class for the Bank's persistence backends
+
+    Accounts are addressed by server ID and user ID and are passed around
+    as AccountRecords. Backends raise KeyError for accounts that don't
+    exist"""
+
+    def __init__(self, path):
+        self.path = path
+        self.logger = logging.getLogger("red.bank")
+
+    def get_account(self, server_id, user_id):
+        raise NotImplementedError
+
+    def set_account(self, server_id, user_id, account):
+        raise NotImplementedError
+
+    def get_legacy_account(self, user_id):
+        """Returns an account from the old, serverless bank format"""
+        return None
+
+    def wipe_server(self, server_id):
+        raise NotImplementedError
+
+    def get_server_accounts(self, server_id):
+        """Returns a {user_id: account} dict of the server's accounts
+
+        The dict must not be modified"""
+        raise NotImplementedError
+
+    def get_server_ids(self):
+        raise NotImplementedError
+
+    def iter_server_ranking(self, server_id):
+        """Yields (user_id, account) by descending balance"""
+        raise NotImplementedError
+
+    def iter_global_ranking(self):
+        """Yields (server_id, user_id, account) by descending balance"""
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class MemoryStorage(BankStorage):
+    """Keeps every account in memory and persists them on each change
+
+    A server's ranking is a sorted list of (-balance, user_id) keys.
+    It's built the first time it's needed and then kept up to date on
+    every change, so leaderboards never sort the whole server again."""
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.accounts = dataIO.load_json(path)
+        self._rankings = {}
+        for server_id in self.get_server_ids():
+            server_accounts = self.accounts[server_id]
+            for user_id, raw in server_accounts.items():
+                server_accounts[user_id] = AccountRecord.from_raw(raw)
+
+    def get_account(self, server_id, user_id):
+        return self.accounts[server_id][user_id]
+
+    def set_account(self, server_id, user_id, account):
+        if server_id not in self.accounts:
+            self.accounts[server_id] = {}
+        old = self.accounts[server_id].get(user_id)
+        self.accounts[server_id][user_id] = account
+        ranking = self._rankings.get(server_id)
+        if ranking is not None:
+            self._update_ranking(ranking, user_id, old, account)
+        self._account_changed(server_id, user_id, account)
+
+    @staticmethod
+    def _update_ranking(ranking, user_id, old, new):
+        if old is not None:
+            if old.balance == new.balance:
+                return
+            del ranking[bisect_left(ranking, (-old.balance, user_id))]
+        insort(ranking, (-new.balance, user_id))
+
+    def _get_ranking(self, server_id):
+        ranking = self._rankings.get(server_id)
+        if ranking is None:
+            accounts = self.get_server_accounts(server_id)
+            ranking = sorted((-acc.balance, user_id)
+                             for user_id, acc in accounts.items())
+            self._rankings[server_id] = ranking
+        return ranking
+
+    def get_legacy_account(self, user_id):
+        account = self.accounts.get(user_id)
+        if account is not None and "balance" in account:
+            return account
+        return None
+
+    def wipe_server(self, server_id):
+        self.accounts[server_id] = {}
+        self._rankings.pop(server_id, None)
+        self._server_wiped(server_id)
+
+    def get_server_accounts(self, server_id):
+        return self.accounts.get(server_id, {})
+
+    def get_server_ids(self):
+        # Legacy accounts live at the top level too
+        return [k for k, v in self.accounts.items() if "balance" not in v]
+
+    def iter_server_ranking(self, server_id):
+        accounts = self.get_server_accounts(server_id)
+        for _, user_id in self._get_ranking(server_id):
+            yield user_id, accounts[user_id]
+
+    def iter_global_ranking(self):
+        # Lazy k-way merge of the servers' rankings: only as many keys
+        # as the caller consumes are popped, at O(log servers) each
+        rankings = [self._iter_keys(server_id)
+                    for server_id in self.get_server_ids()]
+        for _, user_id, server_id in heapq.merge(*rankings):
+            yield server_id, user_id, self.accounts[server_id][user_id]
+
+    def _iter_keys(self, server_id):
+        for neg_balance, user_id in self._get_ranking(server_id):
+            yield neg_balance, user_id, server_id
+
+    def _account_changed(self, server_id, user_id, account):
+        raise NotImplementedError
+
+    def _server_wiped(self, server_id):
+        raise NotImplementedError
+
+
+class JSONStorage(MemoryStorage):
+    """Rewrites the whole bank file on every change"""
+
+    def __init__(self, path):
+        # Left as is, a journal would be ignored now and replayed over
+        # newer balances once the journal backend is picked again
+        fold_journal(path)
+        super().__init__(path)
+
+    def _account_changed(self, server_id, user_id, account):
+        dataIO.mark_dirty(self.path, self.accounts)
+
+    def _server_wiped(self, server_id):
+        dataIO.mark_dirty(self.path, self.accounts)
+
+
+class JournalStorage(MemoryStorage):
+    """Appends every change to a journal next to the bank file
+
+    The bank file acts as a snapshot: at startup the journal is replayed
+    on top of it, and every `compact_every` records the journal is folded
+    back into a fresh snapshot. Records are flushed to the OS as soon as
+    they're written, while fsync is batched every `fsync_every` records
+    or `fsync_interval` seconds, whichever comes first."""
+
+    def __init__(self, path, *, fsync_every=32, fsync_interval=1.0,
+                 compact_every=10000):
+        super().__init__(path)
+        self.journal_path = os.path.splitext(path)[0] + ".journal"
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.compact_every = compact_every
+        self._records = self._replay()
+        self._pending = 0
+        self._last_sync = time.monotonic()
+        self._journal = open(self.journal_path, encoding="utf-8", mode="a")
+        if self._records:
+            self.compact()
+
+    def _replay(self):
+        records = 0
+        try:
+            f = open(self.journal_path, mode="rb")
+        except FileNotFoundError:
+            return records
+        with f:
+            valid_end = 0  # Offset right after the last complete record
+            for line in f:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("Unterminated record")
+                    record = json.loads(line.decode("utf-8"))
+                except ValueError:
+                    # Only the last record can be torn by a crash
+                    self.logger.warning("Discarding incomplete record at "
+                                        "the end of {}"
+                                        "".format(self.journal_path))
+                    break
+                self._apply(record)
+                records += 1
+                valid_end += len(line)
+            size = f.seek(0, os.SEEK_END)
+        if size != valid_end:
+            # Cut the torn record off, or the next one appended would be
+            # glued to it and lost on the next replay
+            with open(self.journal_path, mode="r+b") as f:
+                f.truncate(valid_end)
+        return records
+
+    def _apply(self, record):
+        server_id = record["server"]
+        if record["op"] == "set":
+            if server_id not in self.accounts:
+                self.accounts[server_id] = {}
+            account = AccountRecord.from_raw(record["account"])
+            self.accounts[server_id][record["user"]] = account
+        elif record["op"] == "wipe":
+            self.accounts[server_id] = {}
+
+    def _append(self, record):
+        self._journal.write(json.dumps(record, separators=(",", ":")) + "\n")
+        self._journal.flush()
+        self._records += 1
+        self._pending += 1
+        elapsed = time.monotonic() - self._last_sync
+        if self._pending >= self.fsync_every or \
+                elapsed >= self.fsync_interval:
+            self._sync()
+        if self._records >= self.compact_every:
+            self.compact()
+
+    def _sync(self):
+        os.fsync(self._journal.fileno())
+        self._pending = 0
+        self._last_sync = time.monotonic()
+
+    def _account_changed(self, server_id, user_id, account):
+        self._append({"op": "set", "server": server_id, "user": user_id,
+                      "account": account})
+
+    def _server_wiped(self, server_id):
+        self._append({"op": "wipe", "server": server_id})
+
+    def compact(self):
+        """Writes a new snapshot and empties the journal"""
+        if not dataIO.save_json(self.path, self.accounts):
+            return
+        # Records are idempotent: a crash right here only means that
+        # they'll be replayed once more on top of the new snapshot
+        self._journal.truncate(0)
+        self._records = 0
+        self._pending = 0
+
+    def flush(self):
+        if self._pending:
+            self._sync()
+
+    def close(self):
+        if self._records:
+            self.compact()
+        self._journal.close()
+
+
+class SQLiteStorage(BankStorage):
+    """Stores the accounts in a SQLite database next to the bank file
+
+    Nothing is kept in memory: balances and leaderboards are indexed
+    queries. On first use the existing JSON bank file is migrated."""
+
+    def __init__(self, path):
+        super().__init__(path)
+        # The last changes made under the journal backend may not be in
+        # the bank file yet: they must be there before it's migrated
+        fold_journal(path)
+        self.db_path = os.path.splitext(path)[0] + ".db"
+        self.conn = sqlite3.connect(self.db_path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._create_tables()
+        if self._get_meta("migrated") is None:
+            self.migrate_json(path)
+
+    def _create_tables(self):
+        with self.conn:
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS accounts (
+                    server_id TEXT NOT NULL,
+                    user_id TEXT NOT NULL,
+                    name TEXT,
+                    balance INTEGER NOT NULL,
+                    created_at TEXT,
+                    PRIMARY KEY (server_id, user_id)
+                );
+                CREATE INDEX IF NOT EXISTS accounts_server_balance
+                    ON accounts (server_id, balance DESC);
+                CREATE INDEX IF NOT EXISTS accounts_balance
+                    ON accounts (balance DESC);
+                CREATE TABLE IF NOT EXISTS legacy_accounts (
+                    user_id TEXT PRIMARY KEY,
+                    balance INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                );
+            """)
+
+    def _get_meta(self, key):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?",
+                                (key,)).fetchone()
+        return row["value"] if row else None
+
+    def migrate_json(self, json_path):
+        """Imports the accounts of a JSON bank file. Runs only once"""
+        try:
+            data = dataIO.load_json(json_path, cache=False)
+        except UnsupportedFormat:
+            raise  # Migrating nothing would lose the accounts
+        except (FileNotFoundError, json.decoder.JSONDecodeError,
+                InvalidFileIO):
+            data = {}
+        rows = []
+        legacy = []
+        for key, value in data.items():
+            if "balance" in value:
+                legacy.append((key, value["balance"]))
+                continue
+            for user_id, raw in value.items():
+                rows.append((key, user_id) + AccountRecord.from_raw(raw))
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO accounts VALUES "
+                                  "(?, ?, ?, ?, ?)", rows)
+            self.conn.executemany("INSERT OR REPLACE INTO legacy_accounts "
+                                  "VALUES (?, ?)", legacy)
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES "
+                              "('migrated', ?)", (json_path,))
+        if rows or legacy:
+            self.logger.info("Migrated {} accounts from {} to {}"
+                             "".format(len(rows) + len(legacy), json_path,
+                                       self.db_path))
+
+    @staticmethod
+    def _row_to_account(row):
+        return AccountRecord(row["name"], row["balance"], row["created_at"])
+
+    def get_account(self, server_id, user_id):
+        row = self.conn.execute("SELECT name, balance, created_at "
+                                "FROM accounts WHERE server_id = ? "
+                                "AND user_id = ?",
+                                (server_id, user_id)).fetchone()
+        if row is None:
+            raise KeyError(user_id)
+        return self._row_to_account(row)
+
+    def set_account(self, server_id, user_id, account):
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO accounts VALUES "
+                              "(?, ?, ?, ?, ?)",
+                              (server_id, user_id) + account)
+
+    def get_legacy_account(self, user_id):
+        row = self.conn.execute("SELECT balance FROM legacy_accounts "
+                                "WHERE user_id = ?", (user_id,)).fetchone()
+        return {"balance": row["balance"]} if row else None
+
+    def wipe_server(self, server_id):
+        with self.conn:
+            self.conn.execute("DELETE FROM accounts WHERE server_id = ?",
+                              (server_id,))
+
+    def get_server_accounts(self, server_id):
+        cursor = self.conn.execute("SELECT user_id, name, balance, "
+                                   "created_at FROM accounts "
+                                   "WHERE server_id = ?", (server_id,))
+        return {row["user_id"]: self._row_to_account(row) for row in cursor}
+
+    def get_server_ids(self):
+        cursor = self.conn.execute("SELECT DISTINCT server_id FROM accounts")
+        return [row["server_id"] for row in cursor]
+
+    def iter_server_ranking(self, server_id):
+        cursor = self.conn.execute("SELECT user_id, name, balance, "
+                                   "created_at FROM accounts "
+                                   "WHERE server_id = ? "
+                                   "ORDER BY balance DESC", (server_id,))
+        for row in cursor:
+            yield row["user_id"], self._row_to_account(row)
+
+    def iter_global_ranking(self):
+        cursor = self.conn.execute("SELECT server_id, user_id, name, "
+                                   "balance, created_at FROM accounts "
+                                   "ORDER BY balance DESC")
+        for row in cursor:
+            yield row["server_id"], row["user_id"], self._row_to_account(row)
+
+    def close(self):
+        self.conn.close()
+
+
+def fold_journal(path):
+    """Replays into the bank file a journal left behind by an unclean
+    shutdown of the journal backend, then empties it
+
+    Raises InvalidBackend if the journal couldn't be folded"""
+    journal_path = os.path.splitext(path)[0] + ".journal"
+    try:
+        if not os.path.getsize(journal_path):
+            return
+    except FileNotFoundError:
+        return
+    JournalStorage(path).close()
+    if os.path.getsize(journal_path):
+        raise InvalidBackend("{} couldn't be folded into {}. Switch back "
+                             "to the journal backend"
+                             "".format(journal_path, path))
+
+
+BACKENDS = {"json": JSONStorage,
+            "journal": JournalStorage,
+            "sqlite": SQLiteStorage}
+
+
+def get_storage(backend, path):
+    try:
+        cls = BACKENDS[backend]
+    except KeyError:
+        raise InvalidBackend("Unknown bank backend: {}".format(backend))
+    return cls(path)
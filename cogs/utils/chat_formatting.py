@@ -1,3 +1,6 @@
+import re
+
+
 def error(text):
     return "\N{NO ENTRY SIGN} {}".format(text)
 
@@ -31,29 +34,83 @@ def italics(text):
     return "*{}*".format(text)
 
 
+_FENCE = re.compile(r"```[^\n`]*")
+
+
 def pagify(text, delims=["\n"], *, escape=True, shorten_by=8,
-           page_length=2000):
-    """DOES NOT RESPECT MARKDOWN BOXES OR INLINE CODE"""
-    in_text = text
-    if escape:
-        num_mentions = text.count("@here") + text.count("@everyone")
-        shorten_by += num_mentions
+           page_length=2000, box_aware=False):
+    """Splits text into pages, cutting at the last delimiter that fits
+
+    The text is walked once by offset, without re-slicing what's left
+    after every page.
+    If box_aware is True, a code block cut by a page break is closed at
+    the end of the page and reopened, with its language, on the next one.
+    DOES NOT RESPECT INLINE CODE"""
     page_length -= shorten_by
-    while len(in_text) > page_length:
-        closest_delim = max([in_text.rfind(d, 0, page_length)
-                             for d in delims])
-        closest_delim = closest_delim if closest_delim != -1 else page_length
-        if escape:
-            to_send = escape_mass_mentions(in_text[:closest_delim])
+    start = 0
+    text_end = len(text)
+    fence = None
+    while True:
+        prefix = fence + "\n" if fence else ""
+        room = page_length - len(prefix)
+        if escape:  # Each escaped mention gets one character longer
+            room -= (text.count("@here", start, start + room) +
+                     text.count("@everyone", start, start + room))
+        if text_end - start <= room:
+            end = text_end
         else:
-            to_send = in_text[:closest_delim]
-        yield to_send
-        in_text = in_text[closest_delim:]
-
-    if escape:
-        yield escape_mass_mentions(in_text)
-    else:
-        yield in_text
+            if box_aware:
+                room -= 4  # Room for closing the box: "\n```"
+            room = max(room, 1)
+            # Searching from start + 1 always moves forward, even when
+            # the text left begins with a delimiter
+            end = max(text.rfind(d, start + 1, start + room) for d in delims)
+            if end == -1:
+                end = start + room
+        page = text[start:end]
+        if box_aware:
+            if prefix:
+                # The reopened fence already ends the line
+                for d in delims:
+                    if page.startswith(d):
+                        page = page[len(d):]
+                        break
+            for match in _FENCE.finditer(page):
+                fence = match.group(0) if fence is None else None
+            page = prefix + page
+            if fence is not None and end != text_end:
+                page += "\n```"
+        if escape:
+            page = escape_mass_mentions(page)
+        yield page
+        if end == text_end:
+            break
+        start = end
+
+
+def pagify_lines(lines, *, escape=True, shorten_by=8, page_length=2000):
+    """Joins an iterable of lines into pages
+
+    Each page is yielded as soon as it's full, so the lines can be
+    produced lazily. Lines that don't fit in a page are split by pagify"""
+    page_length -= shorten_by
+    page = []
+    size = -1  # No newline before the first line
+    for line in lines:
+        if escape:
+            line = escape_mass_mentions(line)
+        if size + 1 + len(line) > page_length and page:
+            yield "\n".join(page)
+            page = []
+            size = -1
+        if len(line) > page_length:
+            yield from pagify(line, escape=False, shorten_by=0,
+                              page_length=page_length)
+            continue
+        page.append(line)
+        size += 1 + len(line)
+    if page:
+        yield "\n".join(page)
 
 
 def strikethrough(text):
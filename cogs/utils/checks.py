@@ -26,6 +26,43 @@ def is_owner():
 # the permissions required for them.
 # Of course, the owner will always be able to execute commands.
 
+# Resolved permissions and admin / mod roles are cached per member and
+# set of roles, so a member gaining or losing a role gets a new entry.
+# Everything is dropped when the bot's permissions generation (bumped by
+# role, channel and server updates) or the settings' version changes.
+CACHE_SIZE = 10000
+_cache = {}
+_cache_generation = None
+
+def _cached(ctx, key, compute):
+    global _cache_generation
+    generation = (getattr(ctx.bot, "permissions_generation", None),
+                  settings.permissions_version)
+    if generation != _cache_generation or len(_cache) >= CACHE_SIZE:
+        _cache.clear()
+        _cache_generation = generation
+    try:
+        return _cache[key]
+    except KeyError:
+        value = _cache[key] = compute()
+        return value
+
+def _role_ids(member):
+    return tuple(r.id for r in getattr(member, "roles", ()))
+
+def _staff_roles(ctx):
+    """Returns whether the author has the admin role and the mod role"""
+    server = ctx.message.server
+    author = ctx.message.author
+
+    def resolve():
+        names = {r.name.lower() for r in author.roles}
+        return (settings.get_server_admin(server).lower() in names,
+                settings.get_server_mod(server).lower() in names)
+
+    key = ("roles", server.id, author.id, _role_ids(author))
+    return _cached(ctx, key, resolve)
+
 def check_permissions(ctx, perms):
     if is_owner_check(ctx):
         return True
@@ -34,7 +71,8 @@ def check_permissions(ctx, perms):
 
     ch = ctx.message.channel
     author = ctx.message.author
-    resolved = ch.permissions_for(author)
+    key = ("perms", ch.id, author.id, _role_ids(author))
+    resolved = _cached(ctx, key, lambda: ch.permissions_for(author))
     return all(getattr(resolved, name, None) == value for name, value in perms.items())
 
 def role_or_permissions(ctx, check, **perms):
@@ -51,18 +89,23 @@ def role_or_permissions(ctx, check, **perms):
 
 def mod_or_permissions(**perms):
     def predicate(ctx):
-        server = ctx.message.server
-        mod_role = settings.get_server_mod(server).lower()
-        admin_role = settings.get_server_admin(server).lower()
-        return role_or_permissions(ctx, lambda r: r.name.lower() in (mod_role,admin_role), **perms)
+        if check_permissions(ctx, perms):
+            return True
+        if ctx.message.channel.is_private:
+            return False # can't have roles in PMs
+        is_admin, is_mod = _staff_roles(ctx)
+        return is_admin or is_mod
 
     return commands.check(predicate)
 
 def admin_or_permissions(**perms):
     def predicate(ctx):
-        server = ctx.message.server
-        admin_role = settings.get_server_admin(server)
-        return role_or_permissions(ctx, lambda r: r.name.lower() == admin_role.lower(), **perms)
+        if check_permissions(ctx, perms):
+            return True
+        if ctx.message.channel.is_private:
+            return False # can't have roles in PMs
+        is_admin, is_mod = _staff_roles(ctx)
+        return is_admin
 
     return commands.check(predicate)
 
@@ -1,5 +1,6 @@
 from discord.ext.commands.converter import IDConverter
 from discord.ext.commands.errors import BadArgument
+from collections import defaultdict
 import re
 
 
@@ -14,6 +15,117 @@ def _get_from_servers(bot, getter, argument):
     return result
 
 
+class MemberIndex:
+    """Finds members across every server without going through them
+
+    Members are indexed by ID, by name and nickname and by
+    name#discriminator. The index is built once from the bot's servers
+    and kept up to date by the member and server events"""
+
+    EVENTS = ("on_ready", "on_member_join", "on_member_remove",
+              "on_member_update", "on_server_join", "on_server_remove")
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._members = {}  # user id -> {server id: member}
+        self._names = defaultdict(set)  # name or nick -> {(server id, user id)}
+        self._tags = defaultdict(set)  # name#discriminator -> same
+        self.rebuild()
+        for event in self.EVENTS:
+            bot.add_listener(getattr(self, event), event)
+
+    def close(self):
+        for event in self.EVENTS:
+            self.bot.remove_listener(getattr(self, event), event)
+
+    def rebuild(self):
+        self._members.clear()
+        self._names.clear()
+        self._tags.clear()
+        for server in self.bot.servers:
+            for member in server.members:
+                self.add(member)
+
+    def add(self, member):
+        key = (member.server.id, member.id)
+        self._members.setdefault(member.id, {})[member.server.id] = member
+        for name in self._get_names(member):
+            self._names[name].add(key)
+        self._tags[self._get_tag(member)].add(key)
+
+    def discard(self, member):
+        key = (member.server.id, member.id)
+        servers = self._members.get(member.id, {})
+        servers.pop(member.server.id, None)
+        if not servers:
+            self._members.pop(member.id, None)
+        for name in self._get_names(member):
+            self._discard_key(self._names, name, key)
+        self._discard_key(self._tags, self._get_tag(member), key)
+
+    def get_member(self, user_id):
+        servers = self._members.get(user_id)
+        if servers:
+            return next(iter(servers.values()))
+        return None
+
+    def get_member_named(self, name):
+        """Same lookup as Server.get_member_named, on every server"""
+        if len(name) > 5 and name[-5] == "#":
+            member = self._get_indexed(self._tags.get(name))
+            if member is not None:
+                return member
+        return self._get_indexed(self._names.get(name))
+
+    def _get_indexed(self, keys):
+        if not keys:
+            return None
+        server_id, user_id = next(iter(keys))
+        return self._members[user_id][server_id]
+
+    @staticmethod
+    def _get_names(member):
+        return {n for n in (member.name, member.nick) if n is not None}
+
+    @staticmethod
+    def _get_tag(member):
+        return "{}#{}".format(member.name, member.discriminator)
+
+    @staticmethod
+    def _discard_key(index, name, key):
+        keys = index.get(name)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del index[name]
+
+    async def on_ready(self):
+        self.rebuild()
+
+    async def on_member_join(self, member):
+        self.add(member)
+
+    async def on_member_remove(self, member):
+        self.discard(member)
+
+    async def on_member_update(self, before, after):
+        self.discard(before)
+        self.add(after)
+
+    async def on_server_join(self, server):
+        for member in server.members:
+            self.add(member)
+
+    async def on_server_remove(self, server):
+        for member in server.members:
+            self.discard(member)
+
+
+def get_member_index(bot):
+    """Returns the bot's MemberIndex, building it on first use"""
+    return bot.get_service("member_index", lambda: MemberIndex(bot))
+
+
 class GlobalUser(IDConverter):
     """
     This is an (almost) straight copy of discord.py's Member converter
@@ -32,13 +144,25 @@ class GlobalUser(IDConverter):
             if server:
                 result = server.get_member_named(self.argument)
             if result is None:
+                index = get_member_index(bot)
+                result = index.get_member_named(self.argument)
+            if result is None:
+                # Members the index missed, e.g. from large servers
+                # whose member list arrived in chunks
                 result = _get_from_servers(bot, 'get_member_named', self.argument)
+                if result is not None:
+                    index.add(result)
         else:
             user_id = match.group(1)
             if server:
                 result = server.get_member(user_id)
+            if result is None:
+                index = get_member_index(bot)
+                result = index.get_member(user_id)
             if result is None:
                 result = _get_from_servers(bot, 'get_member', user_id)
+                if result is not None:
+                    index.add(result)
 
         if result is None:
             raise BadArgument('User "{}" not found'.format(self.argument))
@@ -1,56 +1,238 @@
+import asyncio
 import json
 import os
 import logging
+import struct
 from random import randint
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Binary files are the magic, the payload's length and the payload
+BINARY_MAGIC = b"\x00RED"
+BINARY_HEADER = struct.Struct(">4sQ")
+
+FORMATS = ("json", "compact", "msgpack")
+
 class InvalidFileIO(Exception):
     pass
 
+class UnsupportedFormat(InvalidFileIO):
+    """The file is fine but can't be decoded with what's installed"""
+    pass
+
 class DataIO():
     def __init__(self):
         self.logger = logging.getLogger("red")
+        self.write_interval = 1.0
+        self.default_format = "json"
+        self._dirty = {}
+        self._formats = {}
+        self._cache = {}
+        self._writer = None
+        self._stopping = False
+        self._wakeup = None
 
     def save_json(self, filename, data):
         """Atomically saves json file"""
+        self._dirty.pop(filename, None)  # Superseded by this save
+        saved = self._save_bytes(filename, self._encode(filename, data))
+        if saved:
+            self._remember(filename, data)
+        return saved
+
+    def set_format(self, filename, fmt):
+        """Sets the format used when saving filename
+
+        json: indented, sorted JSON (default)
+        compact: minified JSON, keys in insertion order
+        msgpack: length prefixed msgpack. Falls back to compact
+                 if msgpack isn't installed
+
+        Loading detects the format on its own"""
+        self._formats[filename] = self._check_format(fmt, filename)
+
+    def set_default_format(self, fmt):
+        """Sets the format used when saving the files that have no
+        format of their own. See set_format"""
+        self.default_format = self._check_format(fmt, "Data files")
+
+    def _check_format(self, fmt, what):
+        if fmt not in FORMATS:
+            raise InvalidFileIO("Unknown file format: {}".format(fmt))
+        if fmt == "msgpack" and msgpack is None:
+            self.logger.warning("msgpack is not installed. {} will be "
+                                "saved as compact JSON".format(what))
+            fmt = "compact"
+        return fmt
+
+    def mark_dirty(self, filename, data):
+        """Schedules an atomic save of data to filename
+
+        Saves of the same file are coalesced by the background writer,
+        which writes each dirty file at most once per interval. If the
+        writer isn't running the file is saved right away"""
+        if self._writer is None:
+            return self.save_json(filename, data)
+        self._dirty[filename] = data
+        return True
+
+    def start_writer(self, loop=None, *, interval=1.0):
+        """Starts saving the files marked dirty in the background"""
+        if self._writer is not None:
+            return
+        loop = loop or asyncio.get_event_loop()
+        self.write_interval = interval
+        self._stopping = False
+        self._writer = loop.create_task(self._write_behind())
+
+    async def stop_writer(self):
+        """Stops the background writer and saves what's left
+
+        The writer is never cancelled: a save it has handed to the
+        executor would keep going and could land after the final one"""
+        writer, self._writer = self._writer, None
+        if writer is not None:
+            self._stopping = True
+            if self._wakeup is not None:
+                self._wakeup.set()
+            await asyncio.wait([writer])
+        await self.flush_dirty()
+
+    async def flush_dirty(self):
+        """Saves every file marked dirty off the event loop"""
+        loop = asyncio.get_event_loop()
+        while self._dirty:
+            filename, data = self._dirty.popitem()
+            # Serialized here: the data can't be safely read from
+            # another thread while the cogs keep changing it
+            content = self._encode(filename, data)
+            saved = await loop.run_in_executor(None, self._save_bytes,
+                                               filename, content)
+            if saved:
+                self._remember(filename, data)
+
+    async def _write_behind(self):
+        self._wakeup = asyncio.Event()
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(),
+                                       self.write_interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush_dirty()
+            except asyncio.CancelledError:
+                raise  # An Exception before Python 3.8
+            except Exception as e:
+                self.logger.exception("Background save failed", exc_info=e)
+        self._wakeup = None
+
+    def _save_bytes(self, filename, content):
         rnd = randint(1000, 9999)
         path, ext = os.path.splitext(filename)
         tmp_file = "{}-{}.tmp".format(path, rnd)
-        self._save_json(tmp_file, data)
-        try:
-            self._read_json(tmp_file)
-        except json.decoder.JSONDecodeError:
-            self.logger.exception("Attempted to write file {} but JSON "
-                                  "integrity check on tmp file has failed. "
-                                  "The original file is unaltered."
-                                  "".format(filename))
+        # The content is serialized once and never parsed back: the
+        # integrity check compares the size on disk to what was written
+        with open(tmp_file, mode="wb") as f:
+            written = f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+            size = os.fstat(f.fileno()).st_size
+        if written != len(content) or size != len(content):
+            self.logger.error("Attempted to write file {} but the integrity "
+                              "check on tmp file has failed ({} of {} bytes "
+                              "written). The original file is unaltered."
+                              "".format(filename, size, len(content)))
+            os.remove(tmp_file)
             return False
         os.replace(tmp_file, filename)
         return True
 
-    def load_json(self, filename):
-        """Loads json file"""
-        return self._read_json(filename)
+    def load_json(self, filename, *, cache=True):
+        """Loads json file
 
-    def is_valid_json(self, filename):
-        """Verifies if json file exists / is readable"""
+        Parsed files are cached until they change on disk. The returned
+        object is shared with later loads of the same file: changes to it
+        should be saved. Pass cache=False for one-off reads of big files"""
+        if filename in self._dirty:  # Newer than what's on disk
+            return self._dirty[filename]
+        stat_key = self._stat_key(filename)
+        cached = self._cache.get(filename)
+        if cached is not None and cached[0] == stat_key:
+            return cached[1]
+        data = self._read_json(filename)
+        if cache:
+            self._cache[filename] = (stat_key, data)
+        return data
+
+    def exists_and_valid(self, filename, *, cache=True):
+        """Verifies if json file exists / is readable
+
+        The file parsed by the check is cached like load_json does, so
+        loading it right after doesn't parse it again. Pass cache=False
+        for big files. Raises UnsupportedFormat for files that exist but
+        can't be decoded here: callers must not replace them with an
+        empty file"""
+        if filename in self._dirty:
+            return True
         try:
-            self._read_json(filename)
+            self.load_json(filename, cache=cache)
             return True
         except FileNotFoundError:
             return False
         except json.decoder.JSONDecodeError:
             return False
+        except UnsupportedFormat:
+            raise
+        except InvalidFileIO:
+            return False
+
+    def is_valid_json(self, filename):
+        """Verifies if json file exists / is readable"""
+        return self.exists_and_valid(filename)
+
+    def _remember(self, filename, data):
+        try:
+            self._cache[filename] = (self._stat_key(filename), data)
+        except FileNotFoundError:
+            self._cache.pop(filename, None)
+
+    @staticmethod
+    def _stat_key(filename):
+        st = os.stat(filename)
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
 
     def _read_json(self, filename):
-        with open(filename, encoding='utf-8', mode="r") as f:
-            data = json.load(f)
-        return data
+        with open(filename, mode="rb") as f:
+            content = f.read()
+        return self._decode(filename, content)
 
-    def _save_json(self, filename, data):
-        with open(filename, encoding='utf-8', mode="w") as f:
-            json.dump(data, f, indent=4,sort_keys=True,
-                separators=(',',' : '))
-        return data
+    def _encode(self, filename, data):
+        fmt = self._formats.get(filename, self.default_format)
+        if fmt == "compact":
+            return json.dumps(data, separators=(',',':')).encode("utf-8")
+        elif fmt == "msgpack":
+            payload = msgpack.packb(data, use_bin_type=True)
+            return BINARY_HEADER.pack(BINARY_MAGIC, len(payload)) + payload
+        return json.dumps(data, indent=4,sort_keys=True,
+            separators=(',',' : ')).encode("utf-8")
+
+    def _decode(self, filename, content):
+        if not content.startswith(BINARY_MAGIC):
+            return json.loads(content.decode("utf-8"))
+        if msgpack is None:
+            raise UnsupportedFormat("{} is in msgpack format but msgpack "
+                                    "is not installed".format(filename))
+        if len(content) < BINARY_HEADER.size:
+            raise InvalidFileIO("{} is truncated".format(filename))
+        magic, length = BINARY_HEADER.unpack_from(content)
+        payload = content[BINARY_HEADER.size:]
+        if len(payload) != length:
+            raise InvalidFileIO("{} is truncated".format(filename))
+        return msgpack.unpackb(payload, raw=False)
 
     def _legacy_fileio(self, filename, IO, data=None):
         """Old fileIO provided for backwards compatibility"""
@@ -0,0 +1,107 @@
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from .bank_storage import AccountRecord, get_storage
+from .dataIO import dataIO
+
+#
+# Benchmark of the global leaderboard: the lazy merge of the servers'
+# rankings against the full sort and linear de-duplication it replaced.
+# Run it from Red's folder:
+#
+#     python -m cogs.utils.leaderboard_benchmark --servers 50 --accounts 400
+#
+
+
+def make_bank(servers, accounts, users, seed):
+    rng = random.Random(seed)
+    bank = {}
+    for s in range(servers):
+        bank["s{}".format(s)] = {
+            "u{}".format(u): ["name", rng.randint(0, 10 ** 9),
+                              "2017-01-01 00:00:00"]
+            for u in rng.sample(range(users), accounts)}
+    return bank
+
+
+def global_top(storage, top):
+    """Bank.get_global_leaderboard, without resolving the members"""
+    seen = set()
+    result = []
+    for server_id, user_id, account in storage.iter_global_ranking():
+        if user_id in seen:
+            continue
+        seen.add(user_id)
+        result.append((user_id, account.balance))
+        if len(result) == top:
+            break
+    return result
+
+
+def legacy_global_top(storage, top):
+    """The leaderboard as it was: sort every account, then drop the users
+    already listed by scanning the list"""
+    accounts = []
+    for server_id in storage.get_server_ids():
+        for user_id, raw in storage.get_server_accounts(server_id).items():
+            accounts.append((user_id, AccountRecord.from_raw(raw)))
+    accounts.sort(key=lambda x: x[1].balance, reverse=True)
+    unique = []
+    for user_id, account in accounts:
+        if not any(user_id == listed for listed, _ in unique):
+            unique.append((user_id, account.balance))
+    return unique[:top]
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Global leaderboard "
+                                                 "benchmark")
+    parser.add_argument("--servers", type=int, default=50)
+    parser.add_argument("--accounts", type=int, default=400,
+                        help="Accounts per server")
+    parser.add_argument("--users", type=int, default=10000,
+                        help="Distinct users the accounts are drawn from")
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--backend", default="json",
+                        choices=("json", "journal", "sqlite"))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--skip-legacy", action="store_true",
+                        help="The legacy leaderboard is quadratic in the "
+                             "number of users")
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    try:
+        path = os.path.join(folder, "bank.json")
+        bank = make_bank(args.servers, args.accounts, args.users, args.seed)
+        dataIO.save_json(path, bank)
+        storage = get_storage(args.backend, path)
+        print("{} servers x {} accounts, {} backend".format(
+            args.servers, args.accounts, args.backend))
+
+        new, cold = timed(global_top, storage, args.top)
+        _, warm = timed(global_top, storage, args.top)
+        print("merged rankings: {:.4f}s cold, {:.4f}s warm"
+              "".format(cold, warm))
+        if not args.skip_legacy:
+            old, elapsed = timed(legacy_global_top, storage, args.top)
+            print("legacy:          {:.4f}s".format(elapsed))
+            if [b for _, b in old] != [b for _, b in new]:
+                print("The two leaderboards differ!")
+        storage.close()
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    main()
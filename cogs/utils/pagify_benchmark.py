@@ -0,0 +1,87 @@
+import argparse
+import time
+
+from .chat_formatting import escape_mass_mentions, pagify
+
+#
+# Micro-benchmark of pagify on megabyte sized texts, against the
+# implementation that re-sliced the text left after every page.
+# Run it from Red's folder:
+#
+#     python -m cogs.utils.pagify_benchmark --sizes 1 4 16
+#
+
+
+def legacy_pagify(text, delims=["\n"], *, escape=True, shorten_by=8,
+                  page_length=2000):
+    """pagify as it was before it walked the text by offset"""
+    in_text = text
+    if escape:
+        num_mentions = text.count("@here") + text.count("@everyone")
+        shorten_by += num_mentions
+    page_length -= shorten_by
+    while len(in_text) > page_length:
+        closest_delim = max([in_text.rfind(d, 0, page_length)
+                             for d in delims])
+        closest_delim = closest_delim if closest_delim != -1 else page_length
+        if escape:
+            to_send = escape_mass_mentions(in_text[:closest_delim])
+        else:
+            to_send = in_text[:closest_delim]
+        yield to_send
+        in_text = in_text[closest_delim:]
+
+    if escape:
+        yield escape_mass_mentions(in_text)
+    else:
+        yield in_text
+
+
+def make_text(megabytes):
+    # No mass mentions: with enough of them the legacy page length
+    # drops below zero and it never returns
+    line = "row {} of the log, with some words to wrap\n"
+    text = []
+    size = 0
+    i = 0
+    while size < megabytes * 1000000:
+        text.append(line.format(i))
+        size += len(text[-1])
+        i += 1
+    return "".join(text)
+
+
+def measure(func, text, repeat, **kwargs):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        pages = sum(1 for _ in func(text, **kwargs))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return pages, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="pagify benchmark")
+    parser.add_argument("--sizes", type=float, nargs="+",
+                        default=[1, 4, 16], help="Sizes of text in MB")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--skip-legacy", action="store_true",
+                        help="Only time the current pagify")
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        text = make_text(size)
+        pages, new = measure(pagify, text, args.repeat)
+        line = "{:>6.1f} MB {:>6} pages  pagify {:.3f}s".format(
+            len(text) / 1000000, pages, new)
+        _, boxed = measure(pagify, text, args.repeat, box_aware=True)
+        line += "  box_aware {:.3f}s".format(boxed)
+        if not args.skip_legacy:
+            _, old = measure(legacy_pagify, text, 1)
+            line += "  legacy {:.3f}s ({:.0f}x)".format(old, old / new)
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,8 @@
-from .dataIO import dataIO
+from .dataIO import dataIO, FORMATS
 from copy import deepcopy
 import discord
 import os
+import re
 import argparse
 
 
@@ -19,13 +20,17 @@ class Settings:
             "PASSWORD": None,
             "OWNER": None,
             "PREFIXES": [],
+            "FORMAT": "json",
             "default": {"ADMIN_ROLE": "Transistor",
                         "MOD_ROLE": "Process",
                         "PREFIXES": []}
                         }
         self._memory_only = False
+        self._prefix_matchers = {}
+        # Bumped when the admin or mod roles change
+        self.permissions_version = 0
 
-        if not dataIO.is_valid_json(self.path):
+        if not dataIO.exists_and_valid(self.path):
             self.bot_settings = deepcopy(self.default_settings)
             self.save_settings()
         else:
@@ -37,13 +42,15 @@ class Settings:
                         print("Adding " + str(key) +
                               " field to red settings.json")
                 dataIO.save_json(self.path, current)
-            self.bot_settings = dataIO.load_json(self.path)
+            self.bot_settings = current
 
         if "default" not in self.bot_settings:
             self.update_old_settings_v1()
 
         if "LOGIN_TYPE" in self.bot_settings:
             self.update_old_settings_v2()
+        # Also used by the cogs' data files
+        dataIO.set_default_format(self.file_format)
         if parse_args:
             self.parse_cmd_arguments()
 
@@ -64,6 +71,10 @@ class Settings:
         parser.add_argument("--admin-role", help="Role seen as admin role by "
                                                  "Red")
         parser.add_argument("--mod-role", help="Role seen as mod role by Red")
+        parser.add_argument("--data-format", choices=FORMATS,
+                            help="Format of the settings and data files: "
+                                 "json, compact (minified JSON) or msgpack. "
+                                 "Existing files switch on their next save")
         parser.add_argument("--no-prompt",
                             action="store_true",
                             help="Disables console inputs. Features requiring "
@@ -98,6 +109,8 @@ class Settings:
             self.default_admin = args.admin_role
         if args.mod_role:
             self.default_mod = args.mod_role
+        if args.data_format:
+            self.file_format = args.data_format
 
         self.no_prompt = args.no_prompt
         self.self_bot = args.self_bot
@@ -118,7 +131,7 @@ class Settings:
 
     def save_settings(self):
         if not self._memory_only:
-            dataIO.save_json(self.path, self.bot_settings)
+            dataIO.mark_dirty(self.path, self.bot_settings)
 
     def update_old_settings_v1(self):
         # This converts the old settings format
@@ -183,6 +196,15 @@ class Settings:
     def password(self, value):
         self.bot_settings["PASSWORD"] = value
 
+    @property
+    def file_format(self):
+        return self.bot_settings["FORMAT"]
+
+    @file_format.setter
+    def file_format(self, value):
+        dataIO.set_default_format(value)
+        self.bot_settings["FORMAT"] = value
+
     @property
     def login_credentials(self):
         if self.token:
@@ -200,6 +222,7 @@ class Settings:
     def prefixes(self, value):
         assert isinstance(value, list)
         self.bot_settings["PREFIXES"] = value
+        self._prefix_matchers.clear()  # Servers can fall back to these
 
     @property
     def default_admin(self):
@@ -212,6 +235,7 @@ class Settings:
         if "default" not in self.bot_settings:
             self.update_old_settings()
         self.bot_settings["default"]["ADMIN_ROLE"] = value
+        self.permissions_version += 1
 
     @property
     def default_mod(self):
@@ -224,6 +248,7 @@ class Settings:
         if "default" not in self.bot_settings:
             self.update_old_settings_v1()
         self.bot_settings["default"]["MOD_ROLE"] = value
+        self.permissions_version += 1
 
     @property
     def servers(self):
@@ -256,6 +281,7 @@ class Settings:
         if server.id not in self.bot_settings:
             self.add_server(server.id)
         self.bot_settings[server.id]["ADMIN_ROLE"] = value
+        self.permissions_version += 1
         self.save_settings()
 
     def get_server_mod(self, server):
@@ -273,6 +299,7 @@ class Settings:
         if server.id not in self.bot_settings:
             self.add_server(server.id)
         self.bot_settings[server.id]["MOD_ROLE"] = value
+        self.permissions_version += 1
         self.save_settings()
 
     def get_server_prefixes(self, server):
@@ -287,6 +314,7 @@ class Settings:
         if server.id not in self.bot_settings:
             self.add_server(server.id)
         self.bot_settings[server.id]["PREFIXES"] = prefixes
+        self._prefix_matchers.pop(server.id, None)
         self.save_settings()
 
     def get_prefixes(self, server):
@@ -294,6 +322,29 @@ class Settings:
         p = self.get_server_prefixes(server)
         return p if p else self.prefixes
 
+    def match_prefix(self, server, content):
+        """Returns the prefix content starts with, or None
+
+        The server's prefixes are compiled into a single regex, longest
+        first, and cached until they change"""
+        sid = None if server is None else server.id
+        try:
+            matcher = self._prefix_matchers[sid]
+        except KeyError:
+            prefixes = sorted(self.get_prefixes(server), key=len,
+                              reverse=True)
+            if prefixes:
+                matcher = re.compile("|".join(map(re.escape, prefixes)))
+            else:
+                matcher = None
+            self._prefix_matchers[sid] = matcher
+        if matcher is None:
+            return None
+        match = matcher.match(content)
+        return match.group() if match else None
+
     def add_server(self, sid):
         self.bot_settings[sid] = self.bot_settings["default"].copy()
+        self._prefix_matchers.pop(sid, None)
+        self.permissions_version += 1
         self.save_settings()
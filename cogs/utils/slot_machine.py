@@ -0,0 +1,215 @@
+from enum import Enum
+from itertools import permutations
+import random
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+NUM_ENC = "\N{COMBINING ENCLOSING KEYCAP}"
+
+
+class SMReel(Enum):
+    wild = "\N{GAME DIE}"
+    cherries = "\N{CHERRIES}"
+    medal = "\N{SPORTS MEDAL}"
+    flc = "\N{FOUR LEAF CLOVER}"
+    dollar = "\N{BANKNOTE WITH DOLLAR SIGN}"
+    bell = "\N{BELL}"
+    moneystack = "\N{MONEY WITH WINGS}"
+    heart = "\N{HEAVY BLACK HEART}"
+    spade = "\N{BLACK SPADE SUIT}"
+    gem = "\N{GEM STONE}"
+    moneybag = "\N{MONEY BAG}"
+    seven = "\N{DIGIT SEVEN}" + NUM_ENC
+
+
+SM_REEL_MULTIPLIERS = {
+    SMReel.cherries: [0, 0, 2, 5, 10, 100],
+    SMReel.medal: [0, 0, 0, 5, 10, 100],
+    SMReel.flc: [0, 0, 0, 5, 20, 100],
+    SMReel.dollar: [0, 0, 0, 5, 20, 100],
+    SMReel.bell: [0, 0, 0, 10, 50, 100],
+    SMReel.moneystack: [0, 0, 0, 10, 50, 100],
+    SMReel.heart: [0, 0, 0, 20, 80, 120],
+    SMReel.spade: [0, 0, 0, 20, 80, 120],
+    SMReel.gem: [0, 0, 0, 50, 100, 150],
+    SMReel.moneybag: [0, 0, 0, 50, 100, 150],
+    SMReel.seven: [0, 0, 10, 50, 100, 300]}
+
+
+def _reel_windows(wild):
+    symbols = [s for s in SMReel if wild or s is not SMReel.wild]
+    return tuple(permutations(symbols, 3))
+
+
+# Every window of 3 symbols each reel can show, top to bottom.
+# Only the 3 middle reels have a wild
+REEL_WINDOWS = (_reel_windows(False),) + (_reel_windows(True),) * 3 + \
+               (_reel_windows(False),)
+
+
+MASK64 = (1 << 64) - 1
+
+
+def splitmix64(state):
+    """Returns the next state and the output of splitmix64"""
+    state = (state + 0x9E3779B97F4A7C15) & MASK64
+    z = state
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & MASK64
+    return state, z ^ (z >> 31)
+
+
+def spin(seed):
+    """Returns the 3 rows of 5 symbols of the spin derived from seed
+
+    A reel used to be shuffled, rotated and its first 3 symbols shown,
+    which makes every window of 3 distinct symbols equally likely. The
+    same outcome is drawn here with one number per reel, all of them
+    derived from a single 64 bit seed so that any spin can be replayed"""
+    columns = []
+    state = seed
+    for windows in REEL_WINDOWS:
+        state, value = splitmix64(state)
+        columns.append(windows[value % len(windows)])
+    return tuple(zip(*columns))
+
+
+class RandomSeeds:
+    """Spin seeds from a random.Random of its own
+
+    Pass a seed to get the same sequence of spins every time"""
+
+    def __init__(self, seed=None):
+        self._random = random.Random(seed)
+
+    def next_seed(self):
+        return self._random.getrandbits(64)
+
+
+class SystemSeeds:
+    """Spin seeds from the operating system's CSPRNG"""
+
+    def __init__(self):
+        self._random = random.SystemRandom()
+
+    def next_seed(self):
+        return self._random.getrandbits(64)
+
+
+class NumpySeeds:
+    """Spin seeds generated in bulk by a NumPy Generator
+
+    Requires NumPy. Seeds are drawn buffer_size at a time"""
+
+    def __init__(self, seed=None, *, buffer_size=4096):
+        if numpy is None:
+            raise RuntimeError("NumpySeeds requires NumPy")
+        self._generator = numpy.random.default_rng(seed)
+        self.buffer_size = buffer_size
+        self._buffer = iter(())
+
+    def next_seed(self):
+        try:
+            return next(self._buffer)
+        except StopIteration:
+            seeds = self._generator.integers(0, 1 << 64, self.buffer_size,
+                                             dtype=numpy.uint64)
+            self._buffer = iter(seeds.tolist())
+            return next(self._buffer)
+
+
+class Payout:
+    @staticmethod
+    def getsymbolcount(in_line, i):
+        count = list([1, SMReel.wild])
+        line = list(in_line)
+
+        if line[i] == SMReel.wild:
+            for j in range(i, len(line) - 1):
+                if line[j] != SMReel.wild:
+                    line[i] = line[j]
+
+        count[1] = line[i]
+
+        for j in range(i, len(line) - 1):
+            if (line[j] == line[j + 1]) or (line[j + 1] == SMReel.wild):
+                line[j + 1] = line[j]
+                count[0] += 1
+            else:
+                return count
+        return count
+
+    @staticmethod
+    def getmultiplierpayout(symbol, count, bet):
+        return [SM_REEL_MULTIPLIERS[symbol][count] * bet, symbol, count]
+
+    @staticmethod
+    def getskipcount(i, count, line):
+        linePos = i + count - 1
+        skip = 0
+
+        while line[linePos] == SMReel.wild:
+            skip += 1
+            linePos -= 1
+
+        return i + (count - skip)
+
+    @staticmethod
+    def getlinepayout(line, bet):
+        payout = []
+        skip = -1
+        for i, symbol in enumerate(line):
+            if skip > i or i == 4:
+                continue
+            count = Payout.getsymbolcount(line, i)
+
+            if count[0] == 2 and (count[1] == SMReel.seven or count[1] == SMReel.cherries):
+                payout.append(Payout.getmultiplierpayout(count[1], 2, bet))
+            elif count[0] > 2:
+                payout.append(Payout.getmultiplierpayout(count[1], count[0], bet))
+            if line[i + count[0] - 1] == SMReel.wild:
+                skip = Payout.getskipcount(i, count[0], line)
+            else:
+                skip = i + count[0]
+        return payout
+
+
+SYMBOL_INDEX = {symbol: i for i, symbol in enumerate(SMReel)}
+
+
+class PayoutTable:
+    """Memoized Payout.getlinepayout
+
+    Lines are packed into a base-12 integer, one digit per symbol. The
+    first time a line is seen its wins are computed by Payout and stored
+    as (multiplier, symbol, count), so every later spin landing on it is
+    a single lookup."""
+
+    def __init__(self):
+        self._table = {}
+
+    @staticmethod
+    def pack(line):
+        key = 0
+        for symbol in line:
+            key = key * 12 + SYMBOL_INDEX[symbol]
+        return key
+
+    def getwins(self, line):
+        key = self.pack(line)
+        try:
+            return self._table[key]
+        except KeyError:
+            wins = tuple((SM_REEL_MULTIPLIERS[symbol][count], symbol, count)
+                         for _, symbol, count in Payout.getlinepayout(line, 1))
+            self._table[key] = wins
+            return wins
+
+    def getlinepayout(self, line, bet):
+        """Same result as Payout.getlinepayout"""
+        return [[multiplier * bet, symbol, count]
+                for multiplier, symbol, count in self.getwins(line)]
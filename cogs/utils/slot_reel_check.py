@@ -0,0 +1,104 @@
+import argparse
+import math
+import random
+import sys
+from collections import Counter, deque
+
+from .slot_machine import SMReel, REEL_WINDOWS, RandomSeeds, spin
+
+#
+# Checks that spin() shows every reel window with the same distribution
+# as the original deque / shuffle / rotate reels. Run it from Red's folder:
+#
+#     python -m cogs.utils.slot_reel_check --spins 300000
+#
+# Exits with 1 if a reel fails the chi-square tests.
+#
+
+
+def legacy_spin(rng):
+    """The reels as Slots.slot_machine used to build them"""
+    reels = []
+    for i in range(5):
+        default_reel = deque(SMReel)
+        if i < 1 or i > 3:
+            default_reel.remove(SMReel.wild)
+
+        rng.shuffle(default_reel)
+        default_reel.rotate(rng.randint(-999, 999))
+        new_reel = deque(default_reel, maxlen=5)
+        reels.append(new_reel)
+    return tuple(tuple(reels[r][i] for r in range(5)) for i in range(3))
+
+
+def count_windows(rows_list):
+    counts = [Counter() for _ in REEL_WINDOWS]
+    for rows in rows_list:
+        for reel, counter in enumerate(counts):
+            counter[(rows[0][reel], rows[1][reel], rows[2][reel])] += 1
+    return counts
+
+
+def chi_square_z(chi2, df):
+    """Wilson-Hilferty approximation of a chi-square value as a z-score"""
+    return (((chi2 / df) ** (1 / 3) - (1 - 2 / (9 * df))) /
+            math.sqrt(2 / (9 * df)))
+
+
+def uniformity(counter, windows, spins):
+    expected = spins / len(windows)
+    chi2 = sum((counter[w] - expected) ** 2 / expected for w in windows)
+    return chi2, len(windows) - 1
+
+
+def homogeneity(old, new, windows):
+    """Two-sample chi-square test: both counts come from one distribution"""
+    n_old = sum(old.values())
+    n_new = sum(new.values())
+    total = n_old + n_new
+    chi2 = 0.0
+    for w in windows:
+        both = old[w] + new[w]
+        for count, n in ((old[w], n_old), (new[w], n_new)):
+            expected = both * n / total
+            chi2 += (count - expected) ** 2 / expected
+    return chi2, len(windows) - 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares spin() with the "
+                                                 "original reels")
+    parser.add_argument("--spins", type=int, default=300000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-z", type=float, default=4.0,
+                        help="Largest z-score accepted for a test")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    seeds = RandomSeeds(args.seed)
+    old = count_windows(legacy_spin(rng) for _ in range(args.spins))
+    new = count_windows(spin(seeds.next_seed()) for _ in range(args.spins))
+
+    failed = False
+    for reel, windows in enumerate(REEL_WINDOWS):
+        if set(old[reel]) - set(windows) or set(new[reel]) - set(windows):
+            print("Reel {}: shows a window missing from REEL_WINDOWS"
+                  "".format(reel + 1))
+            failed = True
+            continue
+        results = (("old uniform", uniformity(old[reel], windows, args.spins)),
+                   ("new uniform", uniformity(new[reel], windows, args.spins)),
+                   ("old vs new", homogeneity(old[reel], new[reel], windows)))
+        line = "Reel {} ({} windows):".format(reel + 1, len(windows))
+        for name, (chi2, df) in results:
+            z = chi_square_z(chi2, df)
+            failed |= abs(z) > args.max_z
+            line += "  {} chi2 {:.0f} (z {:+.2f})".format(name, chi2, z)
+        print(line)
+
+    print("FAILED" if failed else "OK")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
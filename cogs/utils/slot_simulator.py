@@ -0,0 +1,169 @@
+import argparse
+import itertools
+import json
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .slot_machine import (SMReel, SM_REEL_MULTIPLIERS, SYMBOL_INDEX,
+                           REEL_WINDOWS, Payout)
+
+#
+# Offline Monte Carlo simulator of the slot machine.
+# Run it from Red's folder, NumPy is required:
+#
+#     python -m cogs.utils.slot_simulator --spins 10000000
+#
+
+SYMBOLS = list(SMReel)
+BASE = len(SYMBOLS)
+REELS = 5
+ROWS = 3
+
+
+def reel_symbols(reel):
+    """Symbol indexes of a reel. The first and last reel have no wild"""
+    if reel < 1 or reel > 3:
+        return [SYMBOL_INDEX[s] for s in SYMBOLS if s is not SMReel.wild]
+    return list(range(BASE))
+
+
+def visible_windows(reel):
+    """Symbol indexes of every window of 3 symbols the reel can show"""
+    return np.array([[SYMBOL_INDEX[s] for s in window]
+                     for window in REEL_WINDOWS[reel]], dtype=np.int64)
+
+
+def build_tables(multipliers=SM_REEL_MULTIPLIERS):
+    """Evaluates every line the reels can show with Payout's rules
+
+    Returns, indexed by packed line, the total multiplier, the multiplier
+    won by each symbol and whether the line is void"""
+    size = BASE ** REELS
+    total = np.zeros(size)
+    per_symbol = np.zeros((size, BASE))
+    void = np.zeros(size, dtype=bool)
+    for line in itertools.product(*(reel_symbols(r) for r in range(REELS))):
+        key = 0
+        for i in line:
+            key = key * BASE + i
+        try:
+            wins = Payout.getlinepayout([SYMBOLS[i] for i in line], 1)
+        except KeyError:
+            # Some wild-only stretches make Payout fail: the command
+            # errors out before the bid is taken
+            void[key] = True
+            continue
+        for _, symbol, count in wins:
+            multiplier = multipliers[symbol][count]
+            total[key] += multiplier
+            per_symbol[key, SYMBOL_INDEX[symbol]] += multiplier
+    return total, per_symbol, void
+
+
+def simulate(spins, tables, *, multislot=False, batch_size=1000000,
+             seed=None):
+    """Plays spins in batches and returns the statistics of the return,
+    expressed as a multiple of the total bid"""
+    total, per_symbol, void = tables
+    rng = np.random.default_rng(seed)
+    windows = [visible_windows(r) for r in range(REELS)]
+    rows = [0, 1, 2] if multislot else [1]
+    played = voided = hits = 0
+    ret_sum = ret_sq_sum = 0.0
+    contributions = np.zeros(BASE)
+
+    remaining = spins
+    while remaining:
+        n = min(batch_size, remaining)
+        remaining -= n
+        keys = np.zeros((n, ROWS), dtype=np.int64)
+        for reel in range(REELS):
+            drawn = rng.integers(0, len(windows[reel]), size=n)
+            keys = keys * BASE + windows[reel][drawn]
+        keys = keys[:, rows]
+        valid = ~void[keys].any(axis=1)
+        keys = keys[valid]
+        returns = total[keys].sum(axis=1) / len(rows)
+        played += len(keys)
+        voided += n - len(keys)
+        hits += int(np.count_nonzero(returns))
+        ret_sum += float(returns.sum())
+        ret_sq_sum += float(np.square(returns).sum())
+        contributions += per_symbol[keys].sum(axis=(0, 1)) / len(rows)
+
+    mean = ret_sum / played
+    variance = ret_sq_sum / played - mean ** 2
+    return {"spins": played,
+            "void": voided,
+            "rtp": mean,
+            "hit_frequency": hits / played,
+            "variance": variance,
+            "contributions": {SYMBOLS[i].name: c / played
+                              for i, c in enumerate(contributions) if c}}
+
+
+def exact_line_rtp(tables):
+    """Exact expected return of a single line, void lines excluded"""
+    total, _, void = tables
+    keys = np.array([k for k in (
+        sum(i * BASE ** (REELS - 1 - r) for r, i in enumerate(line))
+        for line in itertools.product(*(reel_symbols(r)
+                                        for r in range(REELS))))
+        if not void[k]])
+    return float(total[keys].mean())
+
+
+def print_report(mode, stats, elapsed):
+    print("{} - {:,} spins in {:.1f}s ({:,.0f} spins/s)"
+          "".format(mode, stats["spins"], elapsed,
+                    stats["spins"] / elapsed))
+    print("  RTP:           {:.4%}".format(stats["rtp"]))
+    print("  Hit frequency: {:.4%}".format(stats["hit_frequency"]))
+    print("  Variance:      {:.4f} (std dev {:.4f})"
+          "".format(stats["variance"], stats["variance"] ** 0.5))
+    print("  Void spins:    {:,}".format(stats["void"]))
+    print("  Contribution to RTP by symbol:")
+    for name, c in sorted(stats["contributions"].items(),
+                          key=lambda x: x[1], reverse=True):
+        print("    {:<12}{:.4%}".format(name, c))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Slot machine simulator")
+    parser.add_argument("--spins", type=int, default=10000000)
+    parser.add_argument("--mode", choices=("slot", "multislot", "both"),
+                        default="both")
+    parser.add_argument("--batch-size", type=int, default=1000000)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--multipliers",
+                        help="JSON file of {symbol name: multipliers} "
+                             "overriding SM_REEL_MULTIPLIERS")
+    args = parser.parse_args()
+
+    if np is None:
+        print("The simulator requires NumPy: pip install numpy")
+        return
+
+    multipliers = dict(SM_REEL_MULTIPLIERS)
+    if args.multipliers:
+        with open(args.multipliers, encoding="utf-8") as f:
+            for name, values in json.load(f).items():
+                multipliers[SMReel[name]] = values
+
+    tables = build_tables(multipliers)
+    print("Exact single line RTP: {:.4%}\n".format(exact_line_rtp(tables)))
+    modes = ("slot", "multislot") if args.mode == "both" else (args.mode,)
+    for mode in modes:
+        start = time.perf_counter()
+        stats = simulate(args.spins, tables, multislot=mode == "multislot",
+                         batch_size=args.batch_size, seed=args.seed)
+        print_report(mode, stats, time.perf_counter() - start)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -40,19 +40,56 @@ from io import TextIOWrapper
 description = "Red - A multifunction Discord bot by Twentysix"
 
 
+class PermissionSnapshot:
+    """Everything user_allowed checks, as sets
+
+    Built from the Owner and Mod cogs and the bot's settings, and thrown
+    away whenever one of them changes"""
+
+    def __init__(self, bot):
+        owner_cog = bot.get_cog('Owner')
+        mod_cog = bot.get_cog('Mod')
+        global_ignores = owner_cog.global_ignores if owner_cog else {}
+        ignore_list = mod_cog.ignore_list if mod_cog else {}
+        self.blacklist = frozenset(global_ignores.get("blacklist", ()))
+        self.whitelist = frozenset(global_ignores.get("whitelist", ()))
+        self.ignored_servers = frozenset(ignore_list.get("SERVERS", ()))
+        self.ignored_channels = frozenset(ignore_list.get("CHANNELS", ()))
+        self.settings = bot.settings
+        self.settings_version = bot.settings.permissions_version
+        self._staff_roles = {}
+
+    def staff_roles(self, server):
+        """IDs of the server's roles named as its admin or mod role"""
+        try:
+            return self._staff_roles[server.id]
+        except KeyError:
+            names = (self.settings.get_server_admin(server),
+                     self.settings.get_server_mod(server))
+            roles = frozenset(r.id for r in server.roles if r.name in names)
+            self._staff_roles[server.id] = roles
+            return roles
+
+    def forget_server(self, server):
+        self._staff_roles.pop(server.id, None)
+
+
 class Bot(commands.Bot):
     def __init__(self, *args, **kwargs):
 
         def prefix_manager(bot, message):
             """
-            Returns prefixes of the message's server if set.
+            Returns the prefix the message starts with, out of the
+            prefixes of the message's server if set.
             If none are set or if the message's server is None
-            it will return the global prefixes instead.
+            the global prefixes are used instead.
 
             Requires a Bot instance and a Message object to be
             passed as arguments.
             """
-            return bot.settings.get_prefixes(message.server)
+            prefix = bot.settings.match_prefix(message.server,
+                                               message.content)
+            return [prefix] if prefix is not None else []
 
         self.counter = Counter()
         self.uptime = datetime.datetime.utcnow()  # Refreshed before login
@@ -62,6 +99,9 @@ class Bot(commands.Bot):
         self._shutdown_mode = None
         self.logger = set_logger(self)
         self._last_exception = None
+        self._services = {}
+        self._permissions = None
+        self.permissions_generation = 0
         self.oauth_url = ""
         if 'self_bot' in kwargs:
             self.settings.self_bot = kwargs['self_bot']
@@ -97,8 +137,49 @@ class Bot(commands.Bot):
         If restart is True, the exit code will be 26 instead
         The launcher automatically restarts Red when that happens"""
         self._shutdown_mode = not restart
+        await dataIO.stop_writer()
         await self.logout()
 
+    def get_service(self, name, factory=None):
+        """
+        Returns the service registered under name
+
+        Services are objects shared by every cog, like the bank's account
+        storage. If the service isn't registered yet and a factory is
+        passed, it gets called and its return value registered.
+        Returns None if there is no such service and no factory.
+        """
+        if name not in self._services:
+            if factory is None:
+                return None
+            self._services[name] = factory()
+        return self._services[name]
+
+    def register_service(self, name, service):
+        """Registers a service shared by every cog"""
+        if name in self._services:
+            raise RuntimeError("A service named {} is already "
+                               "registered.".format(name))
+        self._services[name] = service
+
+    def unregister_service(self, name):
+        """Removes a service from the bot"""
+        return self._services.pop(name, None)
+
+    def close_services(self):
+        """Closes every service that can be closed
+
+        Called once the bot has logged out"""
+        while self._services:
+            name, service = self._services.popitem()
+            close = getattr(service, "close", None)
+            if callable(close):
+                try:
+                    close()
+                except Exception as e:
+                    self.logger.exception("Failed to close service "
+                                          "{}".format(name), exc_info=e)
+
     def add_message_modifier(self, func):
         """
         Adds a message modifier to the bot
@@ -140,7 +221,38 @@ class Bot(commands.Bot):
             for page in pages:
                 await self.send_message(ctx.message.channel, page)
 
+    # Stages of the message pipeline, cheapest first. Each one either
+    # drops the message or lets it through to the next
+    MESSAGE_STAGES = ("bot", "no_prefix", "author", "server")
+
+    def filter_message(self, message):
+        """Returns the stage that dropped the message, or None if it
+        should be processed as a command
+
+        The cheap checks run first: most messages have no prefix and
+        never reach role resolution or the ignore lists"""
+        if message.author.bot:
+            return "bot"
+        if self.settings.match_prefix(message.server,
+                                      message.content) is None:
+            return "no_prefix"
+        allowed = self._author_allowed(message)
+        if allowed is None:
+            allowed = self._server_allowed(message)
+            if not allowed:
+                return "server"
+        elif not allowed:
+            return "author"
+        return None
+
     def user_allowed(self, message):
+        allowed = self._author_allowed(message)
+        if allowed is None:
+            allowed = self._server_allowed(message)
+        return allowed
+
+    def _author_allowed(self, message):
+        # Returns None if the server's settings have the final say
         author = message.author
 
         if author.bot:
@@ -149,40 +261,65 @@ class Bot(commands.Bot):
         if author == self.user:
             return self.settings.self_bot
 
-        mod_cog = self.get_cog('Mod')
-        global_ignores = self.get_cog('Owner').global_ignores
-
         if self.settings.owner == author.id:
             return True
 
-        if author.id in global_ignores["blacklist"]:
+        permissions = self.get_permission_snapshot()
+
+        if author.id in permissions.blacklist:
             return False
 
-        if global_ignores["whitelist"]:
-            if author.id not in global_ignores["whitelist"]:
+        if permissions.whitelist:
+            if author.id not in permissions.whitelist:
                 return False
 
-        if not message.channel.is_private:
-            server = message.server
-            names = (self.settings.get_server_admin(
-                server), self.settings.get_server_mod(server))
-            results = map(
-                lambda name: discord.utils.get(author.roles, name=name),
-                names)
-            for r in results:
-                if r is not None:
-                    return True
-
-        if mod_cog is not None:
-            if not message.channel.is_private:
-                if message.server.id in mod_cog.ignore_list["SERVERS"]:
-                    return False
-
-                if message.channel.id in mod_cog.ignore_list["CHANNELS"]:
-                    return False
+        return None
+
+    def _server_allowed(self, message):
+        if message.channel.is_private:
+            return True
+
+        permissions = self.get_permission_snapshot()
+        staff_roles = permissions.staff_roles(message.server)
+        for role in message.author.roles:
+            if role.id in staff_roles:
+                return True
+
+        if message.server.id in permissions.ignored_servers:
+            return False
+
+        if message.channel.id in permissions.ignored_channels:
+            return False
 
         return True
 
+    def get_permission_snapshot(self):
+        permissions = self._permissions
+        if (permissions is None or permissions.settings_version !=
+                self.settings.permissions_version):
+            permissions = self._permissions = PermissionSnapshot(self)
+        return permissions
+
+    def invalidate_permissions(self, server=None):
+        """Makes user_allowed pick up changes to the global ignores, the
+        Mod cog's ignore list or, if a server is passed, its roles
+
+        Also bumps permissions_generation, which drops the role and
+        permission cache of cogs/utils/checks.py"""
+        self.permissions_generation += 1
+        if server is None:
+            self._permissions = None
+        elif self._permissions is not None:
+            self._permissions.forget_server(server)
+
+    def add_cog(self, cog):
+        super().add_cog(cog)
+        self.invalidate_permissions()
+
+    def remove_cog(self, name):
+        super().remove_cog(name)
+        self.invalidate_permissions()
+
     async def pip_install(self, name, *, timeout=None):
         """
         Installs a pip package in the local 'lib' folder in a thread safe
@@ -339,11 +476,45 @@ def initialize(bot_class=Bot, formatter_class=Formatter):
     async def on_command(command, ctx):
         bot.counter["processed_commands"] += 1
 
+    @bot.event
+    async def on_command_completion(command, ctx):
+        # Commands of these cogs can edit the ignore lists
+        if ctx.cog is not None and type(ctx.cog).__name__ in ("Mod", "Owner"):
+            bot.invalidate_permissions()
+
+    @bot.event
+    async def on_server_role_create(role):
+        bot.invalidate_permissions(role.server)
+
+    @bot.event
+    async def on_server_role_delete(role):
+        bot.invalidate_permissions(role.server)
+
+    @bot.event
+    async def on_server_role_update(before, after):
+        bot.invalidate_permissions(after.server)
+
+    @bot.event
+    async def on_server_remove(server):
+        bot.invalidate_permissions(server)
+
+    @bot.event
+    async def on_server_update(before, after):
+        bot.invalidate_permissions(after)  # The owner may have changed
+
+    @bot.event
+    async def on_channel_update(before, after):
+        if not after.is_private:  # Permission overwrites
+            bot.invalidate_permissions(after.server)
+
     @bot.event
     async def on_message(message):
         bot.counter["messages_read"] += 1
-        if bot.user_allowed(message):
+        dropped_by = bot.filter_message(message)
+        if dropped_by is None:
             await bot.process_commands(message)
+        else:
+            bot.counter["messages_dropped_" + dropped_by] += 1
 
     @bot.event
     async def on_command_error(error, ctx):
@@ -529,7 +700,7 @@ def get_answer():
 def set_cog(cog, value):  # TODO: move this out of red.py
     data = dataIO.load_json("data/red/cogs.json")
     data[cog] = value
-    dataIO.save_json("data/red/cogs.json", data)
+    dataIO.mark_dirty("data/red/cogs.json", data)
 
 
 def load_cogs(bot):
@@ -592,6 +763,7 @@ def main(bot):
 
     print("Logging into Discord...")
     bot.uptime = datetime.datetime.utcnow()
+    dataIO.start_writer(bot.loop)
 
     if bot.settings.login_credentials:
         yield from bot.login(*bot.settings.login_credentials,
@@ -633,6 +805,8 @@ if __name__ == '__main__':
                              exc_info=e)
         loop.run_until_complete(bot.logout())
     finally:
+        bot.close_services()
+        loop.run_until_complete(dataIO.stop_writer())
         loop.close()
         if bot._shutdown_mode is True:
             exit(0)